@@ -3,9 +3,11 @@ import logging
 import sqlite3
 from datetime import datetime
 import re
-import json
 import os
 import sys
+import time
+import zlib
+from collections import Counter
 
 # --- 1. КОНФИГУРАЦИЯ И КОНСТАНТЫ (Замените на свои реальные данные) ---
 
@@ -17,36 +19,29 @@ CONTACT_PHONES = ["+998972488886", "+998975690286"]
 DB_NAME = 'dino_club.db'
 LOCATION_COORDS = {'latitude': 40.4979864, 'longitude': 68.7777999}
 PHONE_REGEX = re.compile(r'^\+?\d{9,15}$') 
+# Telegram хранит неподтвержденные апдейты сутки: повтор может прийти в течение этого окна
+UPDATE_DEDUP_WINDOW = 24 * 3600
+UPDATE_DEDUP_PRUNE_EVERY = 500  # раз в столько апдейтов воркер чистит старые update_id
+ADMIN_PAGE_SIZE = 10  # строк на странице списков учеников и вопросов в админке
+ADMIN_LINE_LEN = 300  # длинный вопрос в списке обрезается до стольких символов
+ADMIN_NAME_LEN = 100  # ФИО - свободный текст, в списке обрезается до стольких символов
 
 # --- 2. БАЗА ДАННЫХ ---
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS questions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, 
-        question_text TEXT, date TEXT)'''
-    )
-    cursor.execute('''CREATE TABLE IF NOT EXISTS enrollments (
-        user_id INTEGER PRIMARY KEY, course_key TEXT, 
-        FOREIGN KEY(user_id) REFERENCES users(user_id))'''
-    )
-    conn.commit()
-    conn.close()
+# Схема и миграции - init_db в dino_db.py, общие с dino_club.py: оба бота
+# работают с одним dino_club.db, поэтому запросы ниже перечисляют столбцы явно.
 
-def save_user(user_id, name, info):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', (user_id, name, info))
+# Запросы ниже выполняются в потоке БД через db.run(fn, ...), а не в event loop:
+# conn - общее соединение этого потока (Database из dino_db.py)
+def save_user(conn, user_id, name, info):
+    # UPSERT, а не REPLACE: не теряем статус доставки, который ведет dino_club.py
+    conn.execute('''INSERT INTO users (user_id, full_name, phone) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET full_name = excluded.full_name, phone = excluded.phone,
+        delivery_status = 0''', (user_id, name, info))
     conn.commit()
-    conn.close()
 
-def get_user_data(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+def get_user_data(conn, user_id):
+    return conn.execute('''
         SELECT 
             u.full_name, 
             u.phone, 
@@ -54,71 +49,108 @@ def get_user_data(user_id):
         FROM users u 
         LEFT JOIN enrollments e ON u.user_id = e.user_id 
         WHERE u.user_id = ?
-    ''', (user_id,))
-    data = cursor.fetchone()
-    conn.close()
-    return data
-
-def save_enrollment(user_id, course_key):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO enrollments VALUES (?, ?)', (user_id, course_key))
+    ''', (user_id,)).fetchone()
+
+def save_enrollment(conn, user_id, course_key):
+    conn.execute('INSERT OR REPLACE INTO enrollments (user_id, course_key) VALUES (?, ?)', (user_id, course_key))
+    conn.commit()
+
+def save_question(conn, user_id, text):
+    conn.execute('INSERT INTO questions (user_id, question_text, created_at) VALUES (?, ?, ?)',
+                 (user_id, text, int(time.time())))
     conn.commit()
-    conn.close()
 
-def save_question(user_id, text):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO questions (user_id, question_text, date) VALUES (?, ?, ?)',
-                   (user_id, text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+def get_all_users(conn):
+    return conn.execute('SELECT user_id, full_name, phone FROM users').fetchall()
+
+def delete_user(conn, user_id):
+    conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM enrollments WHERE user_id = ?', (user_id,))
     conn.commit()
-    conn.close()
-
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, full_name, phone FROM users')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-def get_all_questions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, question_text, date FROM questions ORDER BY date DESC')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-def delete_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-    cursor.execute('DELETE FROM enrollments WHERE user_id = ?', (user_id,))
+
+def delete_question(conn, q_id):
+    conn.execute('DELETE FROM questions WHERE id = ?', (q_id,))
     conn.commit()
-    conn.close()
 
-def delete_question(q_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM questions WHERE id = ?', (q_id,))
+def clear_users(conn):
+    conn.execute('DELETE FROM users')
+    conn.execute('DELETE FROM enrollments')
     conn.commit()
-    conn.close()
 
-def clear_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users')
-    cursor.execute('DELETE FROM enrollments')
+def clear_questions(conn):
+    conn.execute('DELETE FROM questions')
     conn.commit()
-    conn.close()
 
-def clear_questions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM questions')
+# Страницы списков в админке. Страница задается ключом первой строки (start),
+# выбираем на строку больше, чтобы знать, есть ли следующая страница.
+# Ученики идут по user_id, вопросы - от новых к старым по id.
+def get_users_page(conn, start, limit):
+    rows = conn.execute('SELECT user_id, full_name, phone FROM users WHERE user_id >= ? ORDER BY user_id LIMIT ?',
+                        (start, limit + 1)).fetchall()
+    prev = conn.execute('SELECT user_id FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT 1 OFFSET ?',
+                        (start, limit - 1)).fetchone()
+    if prev:
+        prev_start = prev[0]
+    elif conn.execute('SELECT 1 FROM users WHERE user_id < ? LIMIT 1', (start,)).fetchone():
+        prev_start = 0  # до начала списка меньше страницы
+    else:
+        prev_start = None
+    # Счетчик ведут триггеры (row_counts): COUNT(*) прошел бы всю таблицу на каждом клике
+    total = conn.execute("SELECT n FROM row_counts WHERE name = 'users'").fetchone()[0]
+    return rows, prev_start, total
+
+NEWEST = 2 ** 63 - 1  # start первой страницы вопросов
+
+def get_questions_page(conn, start, limit):
+    rows = conn.execute('SELECT id, question_text, created_at FROM questions WHERE id <= ? ORDER BY id DESC LIMIT ?',
+                        (start, limit + 1)).fetchall()
+    prev = conn.execute('SELECT id FROM questions WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?',
+                        (start, limit - 1)).fetchone()
+    if prev:
+        prev_start = prev[0]
+    elif conn.execute('SELECT 1 FROM questions WHERE id > ? LIMIT 1', (start,)).fetchone():
+        prev_start = NEWEST
+    else:
+        prev_start = None
+    total = conn.execute("SELECT n FROM row_counts WHERE name = 'questions'").fetchone()[0]
+    return rows, prev_start, total
+
+def delete_users(conn, user_ids):
+    # Все выбранные - одной транзакцией
+    with conn:
+        conn.executemany('DELETE FROM users WHERE user_id = ?', [(i,) for i in user_ids])
+        conn.executemany('DELETE FROM enrollments WHERE user_id = ?', [(i,) for i in user_ids])
+
+def delete_questions(conn, q_ids):
+    with conn:
+        conn.executemany('DELETE FROM questions WHERE id = ?', [(i,) for i in q_ids])
+
+
+# Общая для всех воркеров gunicorn отметка обработанных update_id
+_dedup_claims = 0
+
+
+def claim_update(conn, update_id):
+    """True, если апдейт пришел впервые; False, если его уже взял какой-то воркер.
+
+    Отметку ставит INSERT OR IGNORE по первичному ключу - одна операция,
+    атомарная между процессами. Отметки старше UPDATE_DEDUP_WINDOW
+    удаляются по ходу работы, так что таблица не растет.
+    """
+    global _dedup_claims
+    now = int(datetime.now().timestamp())
+    cursor = conn.execute('INSERT OR IGNORE INTO processed_updates (update_id, seen_at) VALUES (?, ?)', (update_id, now))
+    _dedup_claims += 1
+    if _dedup_claims % UPDATE_DEDUP_PRUNE_EVERY == 0:
+        conn.execute('DELETE FROM processed_updates WHERE seen_at < ?', (now - UPDATE_DEDUP_WINDOW,))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def release_update(conn, update_id):
+    # Апдейт отмечен, но не принят в обработку: повтор от Telegram не должен считаться дублем
+    conn.execute('DELETE FROM processed_updates WHERE update_id = ?', (update_id,))
     conn.commit()
-    conn.close()
 
 
 # --- 3. НАСТРОЙКА БОТА, ТЕКСТЫ И ПРЕДМЕТЫ ---
@@ -129,121 +161,34 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.exceptions import TelegramBadRequest
+from pydantic import ValidationError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dino_content import ContentStore, ContentError
+from dino_db import Database, LoopLagMonitor, init_db
 
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
+db = Database(DB_NAME)
+loop_lag = LoopLagMonitor()
 
-# ИСПРАВЛЕННЫЙ БЛОК ТЕКСТОВ: Все узбекские строки с апострофами обернуты в ДВОЙНЫЕ кавычки
-STRINGS = {
-    'ru': {
-        'menu': 'Выберите действие:', 'sub': '📚 Курсы', 'reg': '📞 Регистрация',
-        'cab': '👤 Кабинет', 'ask': '❓ Вопрос', 'loc': '📍 Локация', 'res': '🏆 Результаты', 'tst': '📝 Тест',
-        'back': '⬅️ Назад', 'cat': 'Направление:', 'fio': 'Введите ФИО:', 
-        'tel': 'Введите телефон (например: +998901234567):', 'tel_error': '❌ Неверный формат телефона. Пожалуйста, введите корректный номер, например: +998901234567',
-        'saved': '✅ Сохранено!', 'select_course': 'Выберите направление для записи:',
-        'contact': '📞 Связь',
-        'reg_already': 'Я уже учусь в Dino Club', 'reg_new': 'Я еще не учусь, но планирую',
-        'reg_prompt': 'Выберите, пожалуйста, ваш статус:',
-        'fio_msg_already': 'Введите Ваше полное ФИО, чтобы мы могли найти Ваш профиль и обновить данные:',
-        'fio_msg_new': 'Введите Ваше полное ФИО для первичной регистрации:',
-        'schedule_header': 'Обзор расписания по курсу:',
-        'reg_complete': 'Регистрация завершена! Вы записаны на курс:'
-    },
-    'uzb': {
-        'menu': "Harakatni tanlang:", 'sub': "📚 Kurslar", 'reg': "📞 Ro'yxatdan o'tish",
-        'cab': "👤 Kabinet", 'ask': "❓ Savol", 'loc': "📍 Manzil", 'res': "🏆 Natijalar", 'tst': "📝 Test",
-        'back': "⬅️ Orqaga", 'cat': "Yo’nalish:", 'fio': "F.I.SH. kiriting:", 
-        'tel': "Telefonni kiriting (masalan: +998901234567):", 'tel_error': "❌ Noto'g'ri telefon formati. Iltimos, to'g'ri raqam kiriting, masalan: +998901234567",
-        'saved': "✅ Saqlandi!",
-        'loc_text': "📍 Biz bu yerda joylashganmiz (Google Xarita havolasi): [Manzil]",
-        'select_course': "Ro'yxatdan o'tish uchun kursni tanlang:",
-        'contact': "📞 Kontakt",
-        'reg_already': "Men allaqachon Dino Clubda o'qiyman", 
-        'reg_new': "Men hali o'qimayman, lekin rejalashtirmoqdaman", 
-        'reg_prompt': "Iltimos, holatingizni tanlang:",
-        'fio_msg_already': "Ma'lumotlaringizni yangilash uchun to'liq F.I.SH.ingizni kiriting:",
-        'fio_msg_new': "Boshlang'ich ro'yxatdan o'tish uchun to'liq F.I.SH.ingizni kiriting:",
-        'schedule_header': "Kurs bo'yicha dars jadvali:",
-        'reg_complete': "Ro'yxatdan o'tish yakunlandi! Siz kursga yozildingiz:" 
-    }
-}
+# Тексты, направления и вопросы теста - в content.json (общий с dino_club.py).
+# Каждый воркер сам замечает правку файла (проверка mtime на входящих апдейтах)
+# и подменяет контент, перезапуск не нужен.
+STRINGS = {}
+SUBJECTS = {}
+ENGLISH_TEST_QUESTIONS = ()
+
+
+def apply_content(content):
+    global STRINGS, SUBJECTS, ENGLISH_TEST_QUESTIONS
+    STRINGS = content.strings
+    SUBJECTS = content.subjects
+    _, ENGLISH_TEST_QUESTIONS = content.tests['english']
 
-SUBJECTS = {
-    "english": {
-        'ru': {'name': "🇬🇧 Английский", 'items': [
-            {"n": "Дина Р.", "t": "Дина Рустамовна", "s": "• Общий курс: Пн/Ср/Пт: 09:30, 14:00, 15:30\n• Общий курс: Вт/Чт/Сб: 09:30, 14:00, 15:30\n• Взрослые: Вечернее время (по договору)"},
-            {"n": "Алина А.", "t": "Алина Алексеевна", "s": "• 5-7 лет: Пн/Ср/Пт 16:30\n• 2-4 классы: Пн/Ср/Пт 14:00\n• 3-4 классы: Вт/Чт/Сб 09:30"},
-            {"n": "IELTS", "t": "Ширин Рустамовна", "s": "• 10-11 классы: Пн/Ср/Пт (время уточняется)"},
-            {"n": "Икболой", "t": "Икболой", "s": "• 4-6 классы: Пн, Ср, Пт 09:00"},
-            {"n": "Дилафруз Ф.", "t": "Дилафруз Фархадовна", "s": "• 3-4 классы: Вт/Чт/Сб 08:30 и 13:30\n• 5-6 классы: Вт/Чт/Сб 15:00"}
-        ]},
-        'uzb': {'name': "🇬🇧 Ingliz tili", 'items': [
-            {"n": "Dina R.", "t": "Dina Rustamovna", "s": "• Umumiy kurs: Du/Cho/Ju: 09:30, 14:00, 15:30\n• Umumiy kurs: Se/Pay/Sha: 09:30, 14:00, 15:30\n• Katta yoshdagilar: Kechki vaqt (so'rov bo'yicha)"},
-            {"n": "Alina A.", "t": "Alina Alekseevna", "s": "• 5-7 yosh: Du/Cho/Ju 16:30\n• 2-4 sinf: Du/Cho/Ju 14:00\n• 3-4 sinf: Se/Pay/Sha 09:30"},
-            {"n": "IELTS", "t": "Shirin Rustamovna", "s": "• 10-11 sinf: Du/Cho/Ju (vaqt aniqlanadi)"},
-            {"n": "Iqboloy", "t": "Iqboloy", "s": "• 4-6 sinf: Du, Cho, Ju 09:00"},
-            {"n": "Dilafruz F.", "t": "Dilafruz Farxadovna", "s": "• 3-4 sinf: Se/Pay/Sha 08:30 va 13:30\n• 5-6 sinf: Se/Pay/Sha 15:00"}
-        ]}
-    },
-    "math": {
-        'ru': {'name': "📐 Математика", 'items': [
-            {"n": "Юрий С.", "t": "Юрий С.", "s": "• 6-11 классы: Вт, Чт 14:00-16:00\n• 2-5 классы: Ср, Сб 14:00-16:00"}
-        ]},
-        'uzb': {'name': "📐 Matematika", 'items': [
-            {"n": "Yuriy S.", "t": "Yuriy S.", "s": "• 6-11 sinf: Se, Pay 14:00-16:00\n• 2-5 sinf: Cho, Sha 14:00-16:00"}
-        ]},
-    },
-    "russian": {
-        'ru': {'name': "🇷🇺 Русский", 'items': [
-            {"n": "Зарина А.", "t": "Зарина А.", "s": "• Групповые занятия (Индивидуально): 16:00"}
-        ]},
-        'uzb': {'name': "🇷🇺 Rus tili", 'items': [
-            {"n": "Zarina A.", "t": "Zarina A.", "s": "• Gruppa darslar (Individual): 16:00"}
-        ]}
-    },
-    "pochemuchka": {
-        'ru': {'name': "👶 Почемучка", 'items': [
-            {"n": "Почемучка", "t": "Алие Ш.", "s": "• Подготовка к школе (русский язык) (5-7 лет): Пн, Ср, Пт 16:30"}
-        ]},
-        'uzb': {'name': '👶 Pochemuchka', 'items': [
-            {"n": "Pochemuchka", "t": "Aliye Sh.", "s": "• Maktabga tayyorlash (Rus Tili) (5-6 yosh): Du, Cho, Ju 16:30"}
-        ]}
-    },
-    "gymnastics": {
-        'ru': {'name': "🤸 ГИМНАСТИКА", 'items': [
-            {"n": "Уточняется", "t": "Тренер", "s": "• Вт, Чт, Сб: время уточняется"}
-        ]},
-        'uzb': {'name': "🤸 GIMNASTIKA", 'items': [
-            {"n": "Anıqlanadi", "t": "Trener", "s": "• Se, Pay, Sha: vaqti aniqlanadi"}
-        ]}
-    },
-    "choreography": {
-        'ru': {'name': "💃 ХОРЕОГРАФИЯ", 'items': [
-            {"n": "Уточняется", "t": "Тренер", "s": "• Даты и время уточняются"}
-        ]},
-        'uzb': {'name': "💃 XOREOGRAFIYA", 'items': [
-            {"n": "Anıqlanadi", "t": "Trener", "s": "• Sanalar va vaqtlar aniqlanadi"}
-        ]}
-    },
-}
 
-ENGLISH_TEST_QUESTIONS = [
-    ["1. My sister ____ at home now.", ["am", "is", "are", "be"], 1],
-    ["2. This is ____ car. We drive it every day.", ["I", "our", "their", "she"], 1],
-    ["3. He always ____ his homework after school.", ["do", "doing", "does", "did"], 2],
-    ["4. I want to buy ____ umbrella.", ["a", "an", "the", "no article"], 1],
-    ["5. They ____ to Paris last year.", ["go", "going", "went", "goes"], 2],
-    ["6. I ____ this film three times already.", ["see", "saw", "have seen", "seeing"], 2],
-    ["7. You ____ study harder if you want to pass the exam.", ["might", "should", "must", "can"], 1],
-    ["8. This book is ____ interesting than the last one.", ["many", "much", "more", "most"], 2],
-    ["9. If it ____ tomorrow, we will stay at home.", ["will rain", "rains", "rained", "raining"], 1],
-    ["10. The meeting was postponed ____ the manager’s illness.", ["despite", "because", "due to", "although"], 2],
-    ["11. She avoids ____ late at night.", ["to drive", "drive", "driving", "drove"], 2],
-    ["12. When the phone ____, I was having dinner.", ["rang", "ring", "was ringing", "has rung"], 0],
-    ["13. If I had a million dollars, I ____ around the world.", ["will travel", "would travel", "travel", "travelled"], 1],
-    ["14. She has lived in London ____ ten years.", ["since", "for", "on", "at"], 1],
-    ["15. The new hospital ____ next year.", ["build", "will be built", "is building", "built"], 1],
-]
+content_store = ContentStore(apply_content)
+content_store.reload()
 
 # --- 4. МАШИНА СОСТОЯНИЙ И КЛАВИАТУРА ---
 
@@ -376,7 +321,7 @@ async def route(c: types.CallbackQuery, state: FSMContext):
         await c.message.answer(text, parse_mode="Markdown")
 
     elif act == "cab":
-        user_data = get_user_data(c.from_user.id)
+        user_data = await db.run(get_user_data, c.from_user.id)
         
         if lang == 'ru':
             if not user_data:
@@ -391,8 +336,9 @@ async def route(c: types.CallbackQuery, state: FSMContext):
 
         else:  # uzb
             if not user_data:
-                # ИСПРАВЛЕНО: удалены экранированные обратные слэши из узбекского текста.
-                await c.message.answer(f"❌ {STRINGS['uzb']['cab'].replace('👤 Kabinet', 'Siz hali ro'yxatdan o'tmagansiz.')} '{STRINGS['uzb']['reg']}' tugmasini bosing.",
+                # ИСПРАВЛЕНО: апострофы узбекского текста ломали f-строку, текст собран заранее
+                not_registered = STRINGS['uzb']['cab'].replace('👤 Kabinet', "Siz hali ro'yxatdan o'tmagansiz.")
+                await c.message.answer(f"❌ {not_registered} '{STRINGS['uzb']['reg']}' tugmasini bosing.",
                                        reply_markup=main_kb(lang))
                 return
             
@@ -464,7 +410,7 @@ async def get_phone(m: types.Message, state: FSMContext):
         await m.answer(STRINGS[lang]['tel_error'])
         return 
 
-    save_user(m.from_user.id, data['n'], m.text)
+    await db.run(save_user, m.from_user.id, data['n'], m.text)
 
     reg_status_ru = "УЖЕ УЧИТСЯ" if data.get('reg_type') == 'already' else "НОВЫЙ КАНДИДАТ"
 
@@ -487,12 +433,16 @@ async def get_phone(m: types.Message, state: FSMContext):
 async def enroll_course(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
     _, _, course_key, lang = c.data.split("_")
+    if course_key not in SUBJECTS:
+        # Кнопка от старой версии контента: направление уже убрали
+        await c.message.answer(STRINGS[lang]['select_course'])
+        return
 
-    save_enrollment(c.from_user.id, course_key)
+    await db.run(save_enrollment, c.from_user.id, course_key)
 
     course_name = SUBJECTS[course_key][lang]['name']
     
-    user_data = get_user_data(c.from_user.id)
+    user_data = await db.run(get_user_data, c.from_user.id)
     name, phone, _ = user_data if user_data else ("Неизвестно", "Неизвестно")
 
     await bot.send_message(
@@ -516,9 +466,9 @@ async def enroll_course(c: types.CallbackQuery, state: FSMContext):
 
 @dp.message(Form.ask_q)
 async def process_ask(m: types.Message, state: FSMContext):
-    save_question(m.from_user.id, m.text)
+    await db.run(save_question, m.from_user.id, m.text)
     
-    user_info = get_user_data(m.from_user.id)
+    user_info = await db.run(get_user_data, m.from_user.id)
     name = user_info[0] if user_info else "Неизвестный пользователь"
 
     await bot.send_message(
@@ -681,13 +631,21 @@ async def finish_test(message: types.Message, state: FSMContext):
         recommendation = ("Отличный результат! Вы можете попробовать курс подготовки к IELTS." if lang == 'ru' else
                           "Ajoyib natija! Siz IELTS ga tayyorgarlik kursini sinab ko'rishingiz mumkin.")
     
-    # ИСПРАВЛЕННЫЙ БЛОК F-СТРОК: узбекский текст обернут в двойные кавычки
+    # Подписи собраны заранее: обратный слэш внутри {} f-строки допустим только с Python 3.12
+    if lang == 'ru':
+        t_done, t_score, t_correct = 'Тест завершен!', 'Ваш результат:', 'правильных ответов.'
+        t_level, t_rec = 'Ваш примерный уровень (неточный):', 'Рекомендация:'
+        t_reg, t_menu = 'Чтобы записаться, нажмите', 'в главном меню.'
+    else:
+        t_done, t_score, t_correct = "Test yakunlandi!", "Sizning taxminiy darajangiz (aniq emas):", "to'g'ri javob."
+        t_level, t_rec = "Sizning darajangiz (aniq emas):", "Tavsiya:"
+        t_reg, t_menu = "Ro'yxatdan o'tish uchun bosing", "asosiy menyuda."
     result_text = (
-        f"🎉 **{('Тест завершен!' if lang == 'ru' else \"Test yakunlandi!\")}**\n"
-        f"{('Ваш результат:' if lang == 'ru' else \"Sizning taxminiy darajangiz (aniq emas):\")} **{final_score} из {total_questions}** {('правильных ответов.' if lang == 'ru' else \"to'g'ri javob.\")}\n\n"
-        f"📊 **{('Ваш примерный уровень (неточный):' if lang == 'ru' else \"Sizning darajangiz (aniq emas):\")}** {level}\n"
-        f"💡 **{('Рекомендация:' if lang == 'ru' else \"Tavsiya:\")}** {recommendation}\n\n"
-        f"{('Чтобы записаться, нажмите' if lang == 'ru' else \"Ro'yxatdan o'tish uchun bosing\")} '📞 {s['reg']}' {('в главном меню.' if lang == 'ru' else \"asosiy menyuda.\")}"
+        f"🎉 **{t_done}**\n"
+        f"{t_score} **{final_score} из {total_questions}** {t_correct}\n\n"
+        f"📊 **{t_level}** {level}\n"
+        f"💡 **{t_rec}** {recommendation}\n\n"
+        f"{t_reg} '📞 {s['reg']}' {t_menu}"
     )
 
     await message.answer(result_text, parse_mode="Markdown")
@@ -698,6 +656,9 @@ async def finish_test(message: types.Message, state: FSMContext):
 
 # --- ОБРАБОТЧИКИ АДМИНА (без изменений) ---
 
+# Кнопки админки может прислать кто угодно (callback_data не секрет): фильтр на каждом обработчике
+IS_ADMIN = F.from_user.id == ADMIN_ID
+
 @dp.message(Command("admin"))
 async def admin(m: types.Message):
     if m.from_user.id == ADMIN_ID:
@@ -710,56 +671,151 @@ async def admin(m: types.Message):
         await m.answer("🛠 Панель администратора:", reply_markup=kb.as_markup())
 
 
-@dp.callback_query(F.data == "adm_l")
+# Списки учеников и вопросов: одно сообщение на страницу из ADMIN_PAGE_SIZE
+# строк. Номерные кнопки отмечают строки, "Удалить выбранные" удаляет отмеченные
+# одной транзакцией, листание и отметки правят то же сообщение.
+# Все состояние - в callback_data (страница и маска отмеченных строк), потому что
+# у каждого воркера gunicorn своя память: adm_p_{вид}_{start}_{маска} - показать
+# страницу, adm_d_{вид}_{start}_{маска}_{подпись} - удалить отмеченное.
+
+def _user_line(row):
+    user_id, full_name, phone = row
+    # Одно длинное ФИО не должно раздувать страницу сверх лимита сообщения
+    if full_name and len(full_name) > ADMIN_NAME_LEN:
+        full_name = full_name[:ADMIN_NAME_LEN] + "…"
+    return f"👤 {full_name}, 📞 {phone}, ID: {user_id}"
+
+def _question_line(row):
+    q_id, question_text, created_at = row
+    date = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
+    if len(question_text) > ADMIN_LINE_LEN:
+        question_text = question_text[:ADMIN_LINE_LEN] + "…"
+    return f"❓ #{q_id} от {date}:\n{question_text}"
+
+# вид -> (запрос страницы, удаление, строка списка, заголовок, текст пустого списка, start первой страницы)
+ADMIN_LISTS = {
+    'u': (get_users_page, delete_users, _user_line, "👥 Зарегистрированные ученики", "База учеников пуста.", 0),
+    'q': (get_questions_page, delete_questions, _question_line, "❓ Анонимные вопросы", "Список вопросов пуст.", NEWEST),
+}
+
+
+def _page_signature(rows):
+    # Подпись набора строк: если список изменился, маска могла съехать на чужие строки
+    return format(zlib.crc32(",".join(str(r[0]) for r in rows).encode()) & 0xffff, 'x')
+
+
+async def render_admin_list(kind, start, mask=0):
+    get_page, _, line, title, empty, first = ADMIN_LISTS[kind]
+    rows, prev_start, total = await db.run(get_page, start, ADMIN_PAGE_SIZE)
+    if not rows and start != first:
+        # Страница опустела после удаления - показываем начало списка
+        rows, prev_start, total = await db.run(get_page, first, ADMIN_PAGE_SIZE)
+        start, mask = first, 0
+    if not rows:
+        return empty, None
+
+    next_start = rows[ADMIN_PAGE_SIZE][0] if len(rows) > ADMIN_PAGE_SIZE else None
+    rows = rows[:ADMIN_PAGE_SIZE]
+    lines = [f"{title} (всего {total}). Отметьте номера и нажмите «Удалить выбранные»:"]
+    kb = InlineKeyboardBuilder()
+    for i, row in enumerate(rows):
+        selected = mask >> i & 1
+        lines.append(f"{'☑️ ' if selected else ''}{i + 1}. {line(row)}")
+        kb.add(types.InlineKeyboardButton(text=f"{'✅' if selected else '❌'} {i + 1}",
+                                          callback_data=f"adm_p_{kind}_{start}_{mask ^ (1 << i)}"))
+    kb.adjust(5)
+    if mask:
+        kb.row(types.InlineKeyboardButton(
+            text=f"🗑 Удалить выбранные ({bin(mask).count('1')})",
+            callback_data=f"adm_d_{kind}_{start}_{mask}_{_page_signature(rows)}"))
+    nav = []
+    if prev_start is not None:
+        nav.append(types.InlineKeyboardButton(text="◀️ Назад", callback_data=f"adm_p_{kind}_{prev_start}_0"))
+    if next_start is not None:
+        nav.append(types.InlineKeyboardButton(text="Вперед ▶️", callback_data=f"adm_p_{kind}_{next_start}_0"))
+    if nav:
+        kb.row(*nav)
+    return "\n\n".join(lines), kb.as_markup()
+
+
+async def show_admin_list(c: types.CallbackQuery, kind, start, mask=0):
+    text, markup = await render_admin_list(kind, start, mask)
+    try:
+        await c.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            await c.message.answer(text, reply_markup=markup)
+
+
+@dp.callback_query(F.data == "adm_l", IS_ADMIN)
 async def adm_l(c: types.CallbackQuery):
     await c.answer()
-    users = get_all_users()
-    if not users:
-        await c.message.answer("База учеников пуста.")
-        return
+    # Панель администратора остается, список - отдельным сообщением
+    text, markup = await render_admin_list('u', 0)
+    await c.message.answer(text, reply_markup=markup)
 
-    await c.message.answer("👥 Зарегистрированные ученики (нажмите '❌ Удалить' для удаления записи):")
 
-    for u in users:
-        user_id, full_name, phone = u
-        text = f"👤 ФИО: {full_name}\n📞 Телефон: {phone}\nID: {user_id}"
-        kb = InlineKeyboardBuilder()
-        kb.add(types.InlineKeyboardButton(text="❌ Удалить", callback_data=f"adm_del_u_{user_id}"))
-        await c.message.answer(text, reply_markup=kb.as_markup())
+@dp.callback_query(F.data == "adm_q", IS_ADMIN)
+async def adm_q(c: types.CallbackQuery):
+    await c.answer()
+    text, markup = await render_admin_list('q', NEWEST)
+    await c.message.answer(text, reply_markup=markup)
 
-    await c.message.answer("--- Конец списка учеников ---")
 
+def _parse_list_callback(data, fields):
+    # adm_p_/adm_d_ -> (вид, start, маска, *остальное) или None, если кнопка чужая или битая
+    parts = data.split("_")[2:]
+    if len(parts) != fields or parts[0] not in ADMIN_LISTS:
+        return None
+    try:
+        return (parts[0], int(parts[1]), int(parts[2]), *parts[3:])
+    except ValueError:
+        return None
 
-@dp.callback_query(F.data == "adm_q")
-async def adm_q(c: types.CallbackQuery):
+
+@dp.callback_query(F.data.startswith("adm_p_"), IS_ADMIN)
+async def adm_page(c: types.CallbackQuery):
     await c.answer()
-    questions = get_all_questions()
-    if not questions:
-        await c.message.answer("Список вопросов пуст.")
+    parsed = _parse_list_callback(c.data, 3)
+    if parsed is None:
         return
+    await show_admin_list(c, *parsed)
 
-    await c.message.answer("❓ Анонимные вопросы (нажмите '🗑 Удалить' для удаления записи):")
-
-    for q in questions:
-        q_id, question_text, date = q
-        text = f"❓ Вопрос #{q_id} от {date}:\n{question_text}"
-        kb = InlineKeyboardBuilder()
-        kb.add(types.InlineKeyboardButton(text="🗑 Удалить", callback_data=f"adm_del_q_{q_id}"))
-        await c.message.answer(text, reply_markup=kb.as_markup())
 
-    await c.message.answer("--- Конец списка вопросов ---")
+@dp.callback_query(F.data.startswith("adm_d_"), IS_ADMIN)
+async def adm_delete_selected(c: types.CallbackQuery):
+    parsed = _parse_list_callback(c.data, 4)
+    if parsed is None:
+        await c.answer()
+        return
+    kind, start, mask, signature = parsed
+    get_page, delete_rows = ADMIN_LISTS[kind][:2]
+    rows, _, _ = await db.run(get_page, start, ADMIN_PAGE_SIZE)
+    rows = rows[:ADMIN_PAGE_SIZE]
+    if _page_signature(rows) != signature:
+        await c.answer("Список изменился, отметьте строки заново.", show_alert=True)
+        await show_admin_list(c, kind, start)
+        return
+    ids = [row[0] for i, row in enumerate(rows) if mask >> i & 1]
+    try:
+        await db.run(delete_rows, ids)
+    except Exception as e:
+        await c.answer(f"❌ Ошибка удаления: {e}", show_alert=True)
+        return
+    await c.answer(f"✅ Удалено: {len(ids)}")
+    await show_admin_list(c, kind, start)
 
 
-@dp.callback_query(F.data == "adm_b")
+@dp.callback_query(F.data == "adm_b", IS_ADMIN)
 async def adm_b(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
     await c.message.answer("Введите текст для рассылки:")
     await state.set_state(Form.bc)
 
 
-@dp.message(Form.bc)
+@dp.message(Form.bc, IS_ADMIN)
 async def bc_f(m: types.Message, state: FSMContext):
-    u = get_all_users()
+    u = await db.run(get_all_users)
     sent_count = 0
     for x in u:
         try:
@@ -771,108 +827,290 @@ async def bc_f(m: types.Message, state: FSMContext):
     await state.clear()
 
 
-@dp.callback_query(F.data.startswith("adm_del_u_"))
+@dp.callback_query(F.data.startswith("adm_del_u_"), IS_ADMIN)
 async def adm_del_u(c: types.CallbackQuery):
     await c.answer()
     try:
         user_id = int(c.data.split("_")[3])
-        delete_user(user_id)
+        await db.run(delete_user, user_id)
         await c.message.edit_text(c.message.text + "\n\n**✅ УДАЛЕНО**", parse_mode="Markdown")
     except Exception as e:
         await c.message.answer(f"❌ Ошибка удаления: {e}")
 
 
-@dp.callback_query(F.data.startswith("adm_del_q_"))
+@dp.callback_query(F.data.startswith("adm_del_q_"), IS_ADMIN)
 async def adm_del_q(c: types.CallbackQuery):
     await c.answer()
     try:
         q_id = int(c.data.split("_")[3])
-        delete_question(q_id)
+        await db.run(delete_question, q_id)
         await c.message.edit_text(c.message.text + "\n\n**✅ УДАЛЕНО**", parse_mode="Markdown")
     except Exception as e:
         await c.message.answer(f"❌ Ошибка удаления: {e}")
 
 
-@dp.callback_query(F.data == "adm_clear_q")
+@dp.callback_query(F.data == "adm_clear_q", IS_ADMIN)
 async def adm_clear_q(c: types.CallbackQuery):
     await c.answer()
-    clear_questions()
+    await db.run(clear_questions)
     await c.message.answer("✅ Все вопросы удалены.")
 
 
-@dp.callback_query(F.data == "adm_clear_u")
+@dp.callback_query(F.data == "adm_clear_u", IS_ADMIN)
 async def adm_clear_u(c: types.CallbackQuery):
     await c.answer()
-    clear_users()
+    await db.run(clear_users)
     await c.message.answer("✅ Все ученики и записи на курсы удалены.")
 
 
-# --- 6. ЗАПУСК БОТА (Webhooks для PythonAnywhere / Render) ---
+@dp.message(Command("reload"))
+async def reload_content(m: types.Message):
+    # Перечитывает content.json только в этом воркере, остальные подхватят правку по mtime
+    if m.from_user.id != ADMIN_ID:
+        return
+    try:
+        content = content_store.reload()
+    except (OSError, ContentError) as e:
+        await m.answer(f"❌ Контент не обновлён, бот работает на прежней версии.\n{e}")
+        return
+    await m.answer(f"✅ Контент обновлён: направлений {len(content.subjects)}.")
 
-# Инициализация асинхронного цикла и базы данных
-init_db()
-# Создаем один глобальный цикл (loop) для переиспользования
-try:
-    loop = asyncio.get_event_loop()
-except RuntimeError:
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
 
-# Функция, которую вызывает WSGI-файл (Render использует Gunicorn с UvicornWorker)
-def application(environ, start_response):
-    
-    # Этот код обрабатывает входящие Webhook-запросы
-    
-    path = os.path.dirname(__file__) 
-    
-    if environ['REQUEST_METHOD'] == 'POST':
-        
-        try:
-            request_body_size = int(environ.get('CONTENT_LENGTH', 0))
-            request_body = environ['wsgi.input'].read(request_body_size)
-        except Exception:
-            request_body = b'{}'
-            
+# --- 6. ЗАПУСК БОТА (Webhook для Render: ASGI-приложение под UvicornWorker) ---
+
+WEBHOOK_DRAIN_TIMEOUT = 10  # секунд на доработку апдейтов при остановке воркера
+# Апдейты обрабатывают UPDATE_WORKERS задач из очереди на UPDATE_QUEUE_SIZE мест.
+# Очередь полна - отвечаем 503, Telegram повторит доставку позже.
+UPDATE_WORKERS = 16
+UPDATE_QUEUE_SIZE = 500
+# Апдейт от Telegram - единицы КБ (текст до 4096 символов плюс разметка); больше
+# этого не читаем и не разбираем, отвечаем 413
+WEBHOOK_MAX_BODY = 256 * 1024
+WEBHOOK_LOG_BODY_BYTES = 300  # сколько байт тела отклоненного запроса попадает в лог
+WEBHOOK_ERROR_LOG_INTERVAL = 10  # секунд: не чаще одной записи об отклоненных запросах
+
+_init_conn = sqlite3.connect(DB_NAME)
+init_db(_init_conn)
+_init_conn.close()
+
+# accepted/shed/duplicate/rejected/processed/failed - счетчики апдейтов, wait_ms - суммарное
+# ожидание в очереди, max_depth - наибольшая глубина очереди с запуска воркера
+UPDATE_STATS = Counter()
+_update_queue = None
+_update_workers = []
+
+
+async def _update_worker():
+    while True:
+        update, queued_at = await _update_queue.get()
+        UPDATE_STATS['wait_ms'] += int((time.monotonic() - queued_at) * 1000)
         try:
-            data = json.loads(request_body)
-            update = types.Update.model_validate(data)
-            
-            # Используем глобальный цикл для обработки обновления
-            # Примечание: aiogram 3+ требует, чтобы мы подали update в dp.feed_update
-            loop.run_until_complete(dp.feed_update(bot, update))
-            
-            status = '200 OK'
-            response_headers = [('Content-type', 'text/plain')]
-            start_response(status, response_headers)
-            return [b'ok'] 
-            
+            await dp.feed_update(bot, update)
+            UPDATE_STATS['processed'] += 1
         except Exception as e:
-            # Логирование ошибок в файл
-            error_msg = f"Error processing update: {e}\n{request_body.decode('utf-8', 'ignore')}\n\n"
-            # Для Render лучше логировать в stdout/stderr, но для PythonAnywhere файл лучше:
-            # with open(os.path.join(path, 'webhook_error_log.txt'), 'a') as f:
-            #     f.write(error_msg)
-            logging.error(error_msg)
-            
-            status = '500 Internal Server Error'
-            response_headers = [('Content-type', 'text/plain')]
-            start_response(status, response_headers)
-            return [b'error']
+            UPDATE_STATS['failed'] += 1
+            logging.error(f"Error processing update {update.update_id}: {e!r}")
+        finally:
+            _update_queue.task_done()
+
+
+def _start_update_workers():
+    # Очередь и воркеры создаются на цикле UvicornWorker: при старте (lifespan)
+    # или на первом апдейте, если сервер запущен без lifespan
+    global _update_queue
+    if _update_queue is None:
+        _update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        _update_workers.extend(asyncio.create_task(_update_worker()) for _ in range(UPDATE_WORKERS))
+
+
+async def _stop_update_workers():
+    if _update_queue is None:
+        return
+    try:
+        await asyncio.wait_for(_update_queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"Shutdown: {_update_queue.qsize()} updates left unprocessed")
+    for task in _update_workers:
+        task.cancel()
+    await asyncio.gather(*_update_workers, return_exceptions=True)
+
+
+def update_metrics():
+    st = UPDATE_STATS
+    depth = _update_queue.qsize() if _update_queue else 0
+    done = st['processed'] + st['failed']
+    lines = [
+        f"queue_depth {depth}",
+        f"queue_max_depth {st['max_depth']}",
+        f"queue_capacity {UPDATE_QUEUE_SIZE}",
+        f"workers {UPDATE_WORKERS}",
+        f"updates_accepted {st['accepted']}",
+        f"updates_shed {st['shed']}",
+        f"updates_duplicate {st['duplicate']}",
+        f"updates_rejected {st['rejected']}",
+        f"updates_processed {st['processed']}",
+        f"updates_failed {st['failed']}",
+        f"queue_wait_avg_ms {st['wait_ms'] // done if done else 0}",
+        f"loop_stalls {loop_lag.stats['stalls']}",
+        f"loop_lag_max_ms {loop_lag.stats['max_ms']}",
+    ]
+    return "\n".join(lines).encode()
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def _read_body(scope, receive, limit=WEBHOOK_MAX_BODY):
+    # None - клиент отключился; больше limit байт не держим в памяти
+    for name, value in scope.get('headers', ()):
+        if name == b'content-length' and value.isdigit() and int(value) > limit:
+            raise BodyTooLarge(int(value))
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(size)
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+_reject_logged_at = float('-inf')
+_reject_suppressed = 0
+
+
+def _log_rejected(reason, body=b''):
+    # Мусорные запросы могут идти потоком: пишем не чаще раза в
+    # WEBHOOK_ERROR_LOG_INTERVAL и только начало тела
+    global _reject_logged_at, _reject_suppressed
+    UPDATE_STATS['rejected'] += 1
+    now = time.monotonic()
+    if now - _reject_logged_at < WEBHOOK_ERROR_LOG_INTERVAL:
+        _reject_suppressed += 1
+        return
+    suppressed = f", ещё {_reject_suppressed} отклонено без записи в лог" if _reject_suppressed else ""
+    _reject_logged_at = now
+    _reject_suppressed = 0
+    head = body[:WEBHOOK_LOG_BODY_BYTES].decode('utf-8', 'replace')
+    logging.error(f"Rejected webhook request: {reason} ({len(body)} bytes{suppressed}): {head!r}")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _start_update_workers()
+            loop_lag.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _stop_update_workers()
+            await loop_lag.stop()
+            await db.close()
+            await bot.session.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI-приложение, которое gunicorn запускает через UvicornWorker.
+
+    Апдейт разбирается, кладется в ограниченную очередь и сразу
+    подтверждается Telegram ответом 200; обработчики выполняет пул задач
+    на цикле воркера. Долгий обработчик (рассылка, тест с паузами) не
+    держит HTTP-запрос. Если очередь полна, ответ 503: Telegram повторит
+    доставку позже, а уже принятые апдейты не ждут бесконечно. Повторная
+    доставка того же update_id (в любой воркер) подтверждается без
+    обработки, см. claim_update. GET /metrics - счетчики очереди воркера.
+    """
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] != 'POST':
+        if scope.get('path') == '/metrics':
+            await _respond(send, 200, update_metrics())
+            return
+        # Для GET-запросов (проверка работоспособности)
+        await _respond(send, 200, b'Dino Club Bot is running (Webhook mode).')
+        return
+
+    try:
+        request_body = await _read_body(scope, receive)
+    except BodyTooLarge as e:
+        _log_rejected(f"body too large: {e.args[0]} bytes")
+        await _respond(send, 413, b'too large')
+        return
+    if request_body is None:
+        return
+    try:
+        # JSON разбирается прямо в модель (pydantic-core), без промежуточного dict
+        update = types.Update.model_validate_json(request_body)
+    except ValidationError as e:
+        first = e.errors(include_url=False, include_input=False)[0]
+        loc = '.'.join(map(str, first['loc']))
+        _log_rejected(f"{e.error_count()} validation errors, first: {loc}: {first['msg']}", request_body)
+        await _respond(send, 400, b'bad update')
+        return
+
+    _start_update_workers()
+    loop_lag.start()
+    # Проверяем место до отметки в processed_updates: иначе повтор отклоненного
+    # апдейта посчитался бы дублем и потерялся
+    if _update_queue.full():
+        UPDATE_STATS['shed'] += 1
+        await _respond(send, 503, b'busy')
+        return
+
+    try:
+        first_delivery = await db.run(claim_update, update.update_id)
+    except sqlite3.Error as e:
+        # Без отметки лучше обработать, чем потерять апдейт
+        logging.error(f"Update dedup failed for {update.update_id}: {e}")
+        first_delivery = True
+    if not first_delivery:
+        UPDATE_STATS['duplicate'] += 1
+        logging.info(f"Duplicate update {update.update_id} skipped")
+        await _respond(send, 200, b'ok')
+        return
+
+    content_store.check()
+    try:
+        _update_queue.put_nowait((update, time.monotonic()))
+    except asyncio.QueueFull:
+        # Место заняли, пока ставилась отметка
+        UPDATE_STATS['shed'] += 1
+        await db.run(release_update, update.update_id)
+        await _respond(send, 503, b'busy')
+        return
+    UPDATE_STATS['accepted'] += 1
+    UPDATE_STATS['max_depth'] = max(UPDATE_STATS['max_depth'], _update_queue.qsize())
+    await _respond(send, 200, b'ok')
 
-    # Для GET-запросов (проверка работоспособности)
-    status = '200 OK'
-    response_headers = [('Content-type', 'text/plain')]
-    start_response(status, response_headers)
-    return [b'Dino Club Bot is running (Webhook mode).']
 
 # Этот блок остался для локального запуска, если он понадобится.
 if __name__ == "__main__":
     async def local_main():
         logging.info("Starting bot in Polling mode (local).")
+        asyncio.create_task(content_store.watch())
+        loop_lag.start()
         await dp.start_polling(bot)
-        
+
     try:
-        loop.run_until_complete(local_main())
+        asyncio.run(local_main())
     except KeyboardInterrupt:
         logging.info("Bot stopped by user.")
     except Exception as e:
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+# --- КОНТЕНТ БОТА (ТЕКСТЫ, НАПРАВЛЕНИЯ, ТЕСТЫ) ---
+# Тексты, расписание и вопросы теста лежат в content.json рядом с этим файлом
+# и общие для dino_club.py и bot_app.py. Файл можно править без перезапуска:
+# ContentStore замечает изменение (по mtime) и подменяет контент целиком.
+
+CONTENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'content.json')
+CONTENT_POLL_INTERVAL = 5.0  # секунд между проверками mtime
+
+LANGS = ('ru', 'uzb')
+REQUIRED_STRINGS = (
+    'menu', 'sub', 'reg', 'cab', 'ask', 'loc', 'res', 'tst', 'back', 'cat', 'fio', 'tel', 'tel_error',
+    'saved', 'select_course', 'contact', 'fio_msg_new', 'schedule_header', 'reg_complete', 'reg_data_saved',
+    'reg_already', 'reg_new', 'reg_prompt', 'fio_msg_already',
+)
+REQUIRED_TESTS = ('english',)
+# Ключ направления - поле callback_data, а она не длиннее 64 байт. В dino_club.py
+# поля упакованы как "код:поле:..." и делятся по ":", а webhook-бот (bot_app.py)
+# с тем же content.json все еще собирает "cat_{key}_{lang}" и делит по "_",
+# поэтому ключ - только a-z и 0-9 и не длиннее 32 символов
+SUBJECT_KEY_RE = re.compile(r'^[a-z0-9]{1,32}$')
+MAX_TEST_OPTIONS = 4  # варианты подписываются A-D
+
+# strings: {lang: {key: text}}
+# subjects: {key: {lang: {'name': str, 'items': [{'n', 't', 's'}, ...]}}}
+# tests: {name: (bank_id, ((вопрос, (варианты, ...), индекс верного), ...))}
+Content = namedtuple('Content', 'strings subjects tests')
+
+
+class ContentError(ValueError):
+    pass
+
+
+def _check(cond, msg):
+    if not cond:
+        raise ContentError(msg)
+
+
+def _validate_strings(raw):
+    _check(isinstance(raw, dict), "strings: ожидается объект")
+    strings = {}
+    for lang in LANGS:
+        texts = raw.get(lang)
+        _check(isinstance(texts, dict), f"strings.{lang}: нет текстов для языка")
+        missing = [k for k in REQUIRED_STRINGS if k not in texts]
+        _check(not missing, f"strings.{lang}: не хватает ключей {', '.join(missing)}")
+        for k, v in texts.items():
+            _check(isinstance(v, str), f"strings.{lang}.{k}: ожидается строка")
+        strings[lang] = dict(texts)
+    return strings
+
+
+def _validate_subjects(raw):
+    _check(isinstance(raw, dict) and raw, "subjects: ожидается непустой объект")
+    subjects = {}
+    for key, by_lang in raw.items():
+        _check(SUBJECT_KEY_RE.match(key), f"subjects.{key}: ключ должен состоять из a-z и 0-9")
+        _check(isinstance(by_lang, dict), f"subjects.{key}: ожидается объект")
+        subjects[key] = {}
+        for lang in LANGS:
+            subj = by_lang.get(lang)
+            where = f"subjects.{key}.{lang}"
+            _check(isinstance(subj, dict), f"{where}: нет данных для языка")
+            _check(isinstance(subj.get('name'), str), f"{where}.name: ожидается строка")
+            _check(isinstance(subj.get('items'), list), f"{where}.items: ожидается список")
+            items = []
+            for i, it in enumerate(subj['items']):
+                _check(isinstance(it, dict) and all(isinstance(it.get(f), str) for f in 'nts'),
+                       f"{where}.items[{i}]: нужны строки n, t, s")
+                # Лишние поля не тащим в память
+                items.append({'n': it['n'], 't': it['t'], 's': it['s']})
+            subjects[key][lang] = {'name': subj['name'], 'items': items}
+    return subjects
+
+
+def _validate_tests(raw):
+    _check(isinstance(raw, dict), "tests: ожидается объект")
+    tests = {}
+    for name in REQUIRED_TESTS:
+        _check(name in raw, f"tests: нет теста {name}")
+    for name, questions in raw.items():
+        _check(isinstance(questions, list) and questions, f"tests.{name}: ожидается непустой список")
+        bank = []
+        for i, q in enumerate(questions):
+            where = f"tests.{name}[{i}]"
+            _check(isinstance(q, list) and len(q) == 3, f"{where}: ожидается [вопрос, [варианты], индекс]")
+            text, options, answer = q
+            _check(isinstance(text, str), f"{where}: текст вопроса должен быть строкой")
+            _check(isinstance(options, list) and 2 <= len(options) <= MAX_TEST_OPTIONS
+                   and all(isinstance(o, str) for o in options),
+                   f"{where}: от 2 до {MAX_TEST_OPTIONS} вариантов-строк")
+            _check(isinstance(answer, int) and 0 <= answer < len(options), f"{where}: неверный индекс ответа")
+            bank.append((text, tuple(options), answer))
+        bank = tuple(bank)
+        # id банка зависит от вопросов: тест, начатый до правки файла,
+        # доигрывается по своему банку, а не по новым ответам
+        digest = hashlib.sha1(json.dumps(bank, ensure_ascii=False).encode()).hexdigest()[:8]
+        tests[name] = (f"{name}-{digest}", bank)
+    return tests
+
+
+def load_content(path=CONTENT_FILE):
+    # Бросает OSError (файл недоступен) или ContentError (битый/неполный контент)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        raise ContentError(f"{path}: неверный JSON: {e}") from None
+    _check(isinstance(data, dict), f"{path}: ожидается объект")
+    try:
+        return Content(
+            strings=_validate_strings(data.get('strings')),
+            subjects=_validate_subjects(data.get('subjects')),
+            tests=_validate_tests(data.get('tests')),
+        )
+    except ContentError as e:
+        raise ContentError(f"{path}: {e}") from None
+
+
+class ContentStore:
+    """Текущий контент и его горячая перезагрузка.
+
+    on_swap(content) вызывается синхронно после каждой успешной загрузки:
+    в нём приложение подменяет свои глобальные ссылки и пересобирает
+    зависящие от контента кэши. Если новый файл не прошёл проверку,
+    остаётся прежний контент.
+    """
+
+    def __init__(self, on_swap, path=CONTENT_FILE, poll_interval=CONTENT_POLL_INTERVAL):
+        self.path = path
+        self.on_swap = on_swap
+        self.poll_interval = poll_interval
+        self.content = None
+        self._stamp = None
+        self._checked = 0.0
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self):
+        stamp = self._stat()
+        content = load_content(self.path)
+        self._stamp = stamp
+        self.content = content
+        self.on_swap(content)
+        return content
+
+    def check(self):
+        # Не чаще раза в poll_interval: stat дешёвый, но вызывается на каждый апдейт
+        now = time.monotonic()
+        if now - self._checked < self.poll_interval:
+            return False
+        self._checked = now
+        try:
+            stamp = self._stat()
+        except OSError as e:
+            logging.error(f"Контент: не удалось проверить {self.path}: {e}")
+            return False
+        if stamp == self._stamp:
+            return False
+        try:
+            self.reload()
+        except (OSError, ContentError) as e:
+            # Тот же битый файл повторно не читаем, ждём следующей правки
+            self._stamp = stamp
+            logging.error(f"Контент не обновлён, используется прежний: {e}")
+            return False
+        logging.info(f"Контент перезагружен из {self.path}")
+        return True
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.check()
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# --- БАЗА ДАННЫХ: ОДНО СОЕДИНЕНИЕ В ВЫДЕЛЕННОМ ПОТОКЕ ---
+# Общий слой для dino_club.py и bot_app.py: запросы SQLite выполняются вне
+# event loop, поэтому медленный запрос (длинный список, блокировка файла
+# другим процессом) не останавливает обработку остальных апдейтов.
+
+LOOP_LAG_INTERVAL = 0.5  # секунд между замерами задержки event loop
+LOOP_LAG_THRESHOLD = 0.1  # задержка больше этой пишется в лог как блокировка
+
+
+class Database:
+    """Долгоживущее соединение SQLite, которым владеет один выделенный поток.
+
+    Все запросы выполняются последовательно в этом потоке: соединение не
+    пересоздается на каждый запрос, а записи не конкурируют друг с другом
+    за блокировку файла ("database is locked").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dino-db",
+                                            initializer=self._connect)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        self._conn = conn
+
+    def _call(self, fn, args):
+        return fn(self._conn, *args)
+
+    async def run(self, fn, *args):
+        # fn(conn, *args) выполняется в потоке БД, результат возвращается в event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    async def close(self):
+        await self.run(lambda conn: conn.close())
+        self._executor.shutdown(wait=True)
+
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Одна схема на dino_club.db для обоих ботов: и dino_club.py, и bot_app.py
+# вызывают init_db при запуске, запросы обоих пишут в таблицы этой версии.
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция переводит
+# базу из версии N-1 в N и выполняется в отдельной транзакции. Новые
+# изменения схемы добавляются только в конец списка MIGRATIONS.
+
+def _migration_1_base(conn):
+    # Исходная схема (базы, созданные до появления миграций, имеют версию 0)
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        question_text TEXT, date TEXT)'''
+                 )
+    conn.execute('''CREATE TABLE IF NOT EXISTS enrollments (
+        user_id INTEGER PRIMARY KEY, course_key TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id))'''
+                 )
+
+
+def _migration_2_question_timestamps(conn):
+    # questions.date (TEXT, локальное время) -> created_at (INTEGER, unix epoch) + индексы
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'questions'").fetchone()
+    conn.execute('''CREATE TABLE questions_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        question_text TEXT, created_at INTEGER NOT NULL)''')
+    conn.execute('''INSERT INTO questions_new (id, user_id, question_text, created_at)
+        SELECT id, user_id, question_text, COALESCE(CAST(strftime('%s', date, 'utc') AS INTEGER), 0)
+        FROM questions''')
+    conn.execute('DROP TABLE questions')
+    conn.execute('ALTER TABLE questions_new RENAME TO questions')
+    if seq:
+        # Не выдаем повторно id уже удаленных вопросов
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'questions'", seq)
+    # Лента вопросов в админке: ORDER BY created_at DESC, id DESC
+    conn.execute('CREATE INDEX idx_questions_created ON questions(created_at, id)')
+    # JOIN/выборки по автору вопроса
+    conn.execute('CREATE INDEX idx_questions_user ON questions(user_id, created_at)')
+
+
+def _migration_3_row_counts(conn):
+    # Счетчик строк, который поддерживают триггеры: COUNT(*) без полного прохода
+    conn.execute('''CREATE TABLE row_counts (
+        name TEXT PRIMARY KEY, n INTEGER NOT NULL) WITHOUT ROWID''')
+    conn.execute("INSERT INTO row_counts SELECT 'questions', COUNT(*) FROM questions")
+    conn.execute('''CREATE TRIGGER questions_count_ins AFTER INSERT ON questions BEGIN
+        UPDATE row_counts SET n = n + 1 WHERE name = 'questions'; END''')
+    conn.execute('''CREATE TRIGGER questions_count_del AFTER DELETE ON questions BEGIN
+        UPDATE row_counts SET n = n - 1 WHERE name = 'questions'; END''')
+
+
+def _migration_4_broadcast_jobs(conn):
+    # Рассылки как задания: переживают перезапуск и не отправляются повторно
+    conn.execute('''CREATE TABLE broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, preview TEXT,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER NOT NULL, finished_at INTEGER)''')
+    conn.execute('''CREATE TABLE broadcast_recipients (
+        job_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+    # Выборка ожидающих получателей и подсчет прогресса без прохода по всему заданию
+    conn.execute('CREATE INDEX idx_bc_recipients_status ON broadcast_recipients(job_id, status, user_id)')
+
+
+def _migration_5_delivery_status(conn):
+    # Итог последней доставки: 0 — доступен, 1 — заблокировал бота, 2 — аккаунт удален
+    conn.execute('ALTER TABLE users ADD COLUMN delivery_status INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE users ADD COLUMN status_at INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN last_ok_at INTEGER')
+    # Покрывающий индекс для выбора получателей рассылки (user_id — это rowid)
+    conn.execute('CREATE INDEX idx_users_delivery ON users(delivery_status, status_at)')
+
+
+def _migration_6_fsm(conn):
+    # Состояния FSM (регистрация, тест, режимы админа) переживают перезапуск
+    conn.execute('''CREATE TABLE fsm (
+        key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL,
+        updated_at INTEGER NOT NULL) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX idx_fsm_updated ON fsm(updated_at)')
+
+
+def _migration_7_question_answers(conn):
+    # Когда админ ответил автору вопроса: по этому времени вопросы уходят при очистке
+    conn.execute('ALTER TABLE questions ADD COLUMN answered_at INTEGER')
+    conn.execute('CREATE INDEX idx_questions_answered ON questions(answered_at) WHERE answered_at IS NOT NULL')
+
+
+def _migration_8_processed_updates(conn):
+    # Отметки update_id webhook-бота (bot_app.py), IF NOT EXISTS - он создавал таблицу и до миграций
+    conn.execute('''CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY, seen_at INTEGER)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_processed_updates_seen ON processed_updates(seen_at)')
+
+
+def _migration_9_user_count(conn):
+    # Тот же счетчик, что у вопросов (миграция 3): страницы учеников в админке без COUNT(*)
+    conn.execute("INSERT INTO row_counts SELECT 'users', COUNT(*) FROM users")
+    conn.execute('''CREATE TRIGGER users_count_ins AFTER INSERT ON users BEGIN
+        UPDATE row_counts SET n = n + 1 WHERE name = 'users'; END''')
+    conn.execute('''CREATE TRIGGER users_count_del AFTER DELETE ON users BEGIN
+        UPDATE row_counts SET n = n - 1 WHERE name = 'users'; END''')
+
+
+MIGRATIONS = [
+    _migration_1_base,
+    _migration_2_question_timestamps,
+    _migration_3_row_counts,
+    _migration_4_broadcast_jobs,
+    _migration_5_delivery_status,
+    _migration_6_fsm,
+    _migration_7_question_answers,
+    _migration_8_processed_updates,
+    _migration_9_user_count,
+]
+
+
+def init_db(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        conn.execute('BEGIN')
+        try:
+            MIGRATIONS[target - 1](conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"DB: схема обновлена до версии {target}")
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        # Режим включается только полным VACUUM - один раз; дальше место после
+        # очистки вопросов возвращает incremental_vacuum без переписывания файла
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        logging.info("DB: включен auto_vacuum=INCREMENTAL")
+
+
+# --- КОНТРОЛЬ ЗАДЕРЖЕК EVENT LOOP ---
+
+class LoopLagMonitor:
+    """Замечает синхронную работу, которая держит event loop.
+
+    Раз в interval засыпает и сравнивает, насколько позже запланированного
+    проснулся. Опоздание больше threshold значит, что какой-то обработчик
+    работал, не отдавая управление, - оно пишется в лог и в stats.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        # checks - замеров, stalls - опозданий больше threshold, max_ms - худшее опоздание
+        self.stats = Counter()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            planned = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - planned
+            self.stats['checks'] += 1
+            self.stats['max_ms'] = max(self.stats['max_ms'], int(lag * 1000))
+            if lag > self.threshold:
+                self.stats['stalls'] += 1
+                logging.warning(f"Event loop был заблокирован на {lag * 1000:.0f} мс")
@@ -1,18 +1,27 @@
 import asyncio
+import json
 import logging
-import sqlite3
+import time
 from datetime import datetime
 import re
 import os
+import sys
+from collections import Counter, OrderedDict, deque
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter,
+                                TelegramNetworkError, TelegramServerError)
 from aiogram.methods import DeleteWebhook
 
+# Общие с webhook-версией модули (контент бота) лежат в "Dino Club"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Dino Club'))
+from dino_content import ContentStore, ContentError
+from dino_db import Database, LoopLagMonitor, init_db
+
 # --- 1. КОНФИГУРАЦИЯ И КОНСТАНТЫ ---
 
 # Настройка логирования
@@ -30,7 +39,13 @@ except ValueError:
     logging.error("ADMIN_IDS: Неверный формат ID. Используйте числа через запятую.")
     ADMIN_IDS = [752077351]  # Защита
 
-NOTIFICATION_ADMIN_ID = ADMIN_IDS[0]
+# Кому из админов уходят уведомления каждого типа. По умолчанию — всем из
+# ADMIN_IDS; чтобы, например, вопросы получал только один админ: 'question': [752077351]
+NOTIFY_ROUTES = {
+    'registration': ADMIN_IDS,
+    'enrollment': ADMIN_IDS,
+    'question': ADMIN_IDS,
+}
 
 ADMIN_USERNAME = "@Dina_Di_Ru"
 CONTACT_PHONES = ["+998972488886", "+998975690286"]
@@ -49,37 +64,29 @@ if API_TOKEN:
 # ----------------------------------------
 
 
-# --- 2. БАЗА ДАННЫХ (ОБЕРНУТО В СИНХРОННЫЕ ФУНКЦИИ ДЛЯ ASYNCIO.TO_THREAD) ---
-
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS questions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
-        question_text TEXT, date TEXT)'''
-                   )
-    cursor.execute('''CREATE TABLE IF NOT EXISTS enrollments (
-        user_id INTEGER PRIMARY KEY, course_key TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(user_id))'''
-                   )
-    conn.commit()
-    conn.close()
+# --- 2. БАЗА ДАННЫХ (ОДНО СОЕДИНЕНИЕ В ВЫДЕЛЕННОМ ПОТОКЕ) ---
+# Database (Dino Club/dino_db.py) выполняет функции вида fn(conn, *args) в своем
+# потоке: db.run(fn, ...). Схема и миграции (init_db) там же - общие с bot_app.py.
+# Ниже - запросы этого бота.
 
 
-def save_user(user_id, name, info):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', (user_id, name, info))
-    conn.commit()
-    conn.close()
+# save_user / save_enrollment / save_question не коммитят сами:
+# их собирает WriteBehind и коммитит пачкой в одной транзакции.
+def save_user(conn, user_id, name, info):
+    # UPSERT, а не REPLACE: не теряем статус доставки и не дергаем DELETE-триггеры
+    conn.execute('''INSERT INTO users (user_id, full_name, phone) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET full_name = excluded.full_name, phone = excluded.phone,
+        delivery_status = 0''', (user_id, name, info))
+
+
+def mark_user_reachable(conn, user_id):
+    # Пользователь сам написал боту — значит, он снова доступен для рассылок
+    conn.execute('UPDATE users SET delivery_status = 0 WHERE user_id = ? AND delivery_status != 0',
+                 (user_id,))
 
 
-def get_user_data(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+def get_user_data(conn, user_id):
+    return conn.execute('''
         SELECT
             u.full_name,
             u.phone,
@@ -87,207 +94,590 @@ def get_user_data(user_id):
         FROM users u
         LEFT JOIN enrollments e ON u.user_id = e.user_id
         WHERE u.user_id = ?
-    ''', (user_id,))
-    data = cursor.fetchone()
-    conn.close()
-    return data
+    ''', (user_id,)).fetchone()
 
 
-def save_enrollment(user_id, course_key):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO enrollments VALUES (?, ?)', (user_id, course_key))
-    conn.commit()
-    conn.close()
-
+def save_enrollment(conn, user_id, course_key):
+    conn.execute('INSERT OR REPLACE INTO enrollments VALUES (?, ?)', (user_id, course_key))
 
-def save_question(user_id, text):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO questions (user_id, question_text, date) VALUES (?, ?, ?)',
-                   (user_id, text, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
 
+def save_question(conn, user_id, text, created_at):
+    conn.execute('INSERT INTO questions (user_id, question_text, created_at) VALUES (?, ?, ?)',
+                 (user_id, text, created_at))
 
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, full_name, phone FROM users')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
 
+def mark_questions_answered(conn, user_id, answered_at):
+    # Админ отвечает пользователю, а не конкретному вопросу: закрываем все открытые
+    conn.execute('UPDATE questions SET answered_at = ? WHERE user_id = ? AND answered_at IS NULL',
+                 (answered_at, user_id))
 
-# --- НОВАЯ ФУНКЦИЯ ДЛЯ РАССЫЛКИ ---
-def get_all_user_ids():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return ids
 
+def apply_writes(conn, batch):
+    # Вся пачка — одна транзакция и один fsync
+    with conn:
+        for fn, args in batch:
+            fn(conn, *args)
 
-# --- КОНЕЦ НОВОЙ ФУНКЦИИ ---
 
-
-def get_all_questions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT q.id, q.user_id, q.question_text, q.date, u.full_name
+def apply_writes_each(conn, batch):
+    # Пачка не прошла: по одной транзакции на операцию, чтобы найти сбойные
+    failed = []
+    for op in batch:
+        fn, args = op
+        try:
+            with conn:
+                fn(conn, *args)
+        except Exception as e:
+            failed.append((op, e))
+    return failed
+
+
+# Лимит Telegram — 4096 символов (UTF-16) на сообщение; оставляем запас на заголовок
+USERS_PAGE_LEN = 3500
+USERS_FETCH_CHUNK = 50
+
+
+def get_users_page(conn, render, cursor=None, backward=False, max_len=USERS_PAGE_LEN):
+    """Страница пользователей, ограниченная длиной отрендеренного текста.
+
+    Строки читаются курсором через fetchmany, пока очередная запись влезает в
+    max_len. cursor — user_id на границе соседней страницы. Возвращает
+    ([(user_id, entry_text)], more), где more — есть ли записи дальше в
+    направлении чтения.
+    """
+    sql = 'SELECT user_id, full_name, phone FROM users'
+    params = ()
+    if cursor is not None:
+        sql += ' WHERE user_id < ?' if backward else ' WHERE user_id > ?'
+        params = (cursor,)
+    sql += ' ORDER BY user_id DESC' if backward else ' ORDER BY user_id'
+
+    cur = conn.execute(sql, params)
+    page, size, more = [], 0, False
+    while not more:
+        chunk = cur.fetchmany(USERS_FETCH_CHUNK)
+        if not chunk:
+            break
+        for row in chunk:
+            entry = render(*row)
+            entry_len = len(entry.encode('utf-16-le')) // 2
+            if page and size + entry_len > max_len:
+                more = True
+                break
+            page.append((row[0], entry))
+            size += entry_len
+    cur.close()
+    if backward:
+        page.reverse()
+    return page, more
+
+
+# --- ЗАДАНИЯ РАССЫЛКИ ---
+# Статусы получателя: ждет -> отправляется -> результат. Перед отправкой
+# получатели помечаются BC_SENDING отдельной транзакцией; если процесс
+# упал, такие строки после перезапуска становятся BC_UNKNOWN и повторно
+# не отправляются (лучше недослать, чем прислать дважды).
+BC_PENDING, BC_SENDING, BC_SENT, BC_BLOCKED, BC_FAILED, BC_UNKNOWN = range(6)
+BC_OUTCOMES = {'sent': BC_SENT, 'blocked': BC_BLOCKED, 'deactivated': BC_BLOCKED, 'failed': BC_FAILED}
+BC_CLAIM_BATCH = 50
+
+# Статус доставки в users: заблокировавших бота и удаленных не включаем в рассылки,
+# но раз в USER_REPROBE_AFTER секунд пробуем снова (вдруг разблокировали)
+USER_BLOCKED, USER_DEACTIVATED = 1, 2
+USER_DELIVERY_STATUS = {'blocked': USER_BLOCKED, 'deactivated': USER_DEACTIVATED}
+USER_REPROBE_AFTER = 30 * 24 * 3600
+
+
+def create_broadcast_job(conn, from_chat_id, message_id, preview):
+    with conn:
+        job_id = conn.execute('''INSERT INTO broadcast_jobs (from_chat_id, message_id, preview, created_at)
+            VALUES (?, ?, ?, ?)''', (from_chat_id, message_id, preview, int(time.time()))).lastrowid
+        total = conn.execute('''INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, user_id FROM users
+            WHERE delivery_status = 0 OR (delivery_status > 0 AND status_at < ?)''',
+                             (job_id, int(time.time()) - USER_REPROBE_AFTER)).rowcount
+        if not total:
+            conn.execute("UPDATE broadcast_jobs SET status = 'done', finished_at = created_at WHERE id = ?",
+                         (job_id,))
+    return job_id, total
+
+
+def claim_broadcast_recipients(conn, job_id, limit=BC_CLAIM_BATCH):
+    with conn:
+        cur = conn.execute('''SELECT user_id FROM broadcast_recipients
+            WHERE job_id = ? AND status = ? ORDER BY user_id''', (job_id, BC_PENDING))
+        user_ids = [row[0] for row in cur.fetchmany(limit)]
+        cur.close()
+        conn.executemany('UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?',
+                         [(BC_SENDING, job_id, user_id) for user_id in user_ids])
+    return user_ids
+
+
+def save_broadcast_results(conn, job_id, results):
+    now = int(time.time())
+    with conn:
+        conn.executemany('UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?',
+                         [(BC_OUTCOMES[outcome], job_id, user_id) for user_id, outcome in results])
+        conn.executemany('UPDATE users SET delivery_status = 0, last_ok_at = ? WHERE user_id = ?',
+                         [(now, user_id) for user_id, outcome in results if outcome == 'sent'])
+        conn.executemany('UPDATE users SET delivery_status = ?, status_at = ? WHERE user_id = ?',
+                         [(USER_DELIVERY_STATUS[outcome], now, user_id) for user_id, outcome in results
+                          if outcome in USER_DELIVERY_STATUS])
+
+
+def release_broadcast_recipients(conn, job_id, user_ids):
+    # Взяты в работу, но отправка даже не начиналась — вернуть в ожидание
+    with conn:
+        conn.executemany('''UPDATE broadcast_recipients SET status = ?
+            WHERE job_id = ? AND user_id = ? AND status = ?''',
+                         [(BC_PENDING, job_id, user_id, BC_SENDING) for user_id in user_ids])
+
+
+def finish_broadcast_job(conn, job_id, status='done'):
+    with conn:
+        return conn.execute("""UPDATE broadcast_jobs SET status = ?, finished_at = ?
+            WHERE id = ? AND status = 'running'""", (status, int(time.time()), job_id)).rowcount
+
+
+def get_running_broadcast_jobs(conn):
+    # Вызывается при старте: все, что было "в отправке" до перезапуска, — неизвестно
+    with conn:
+        conn.execute('''UPDATE broadcast_recipients SET status = ?
+            WHERE status = ? AND job_id IN (SELECT id FROM broadcast_jobs WHERE status = 'running')''',
+                     (BC_UNKNOWN, BC_SENDING))
+    return conn.execute('''SELECT id, from_chat_id, message_id FROM broadcast_jobs
+        WHERE status = 'running' ORDER BY id''').fetchall()
+
+
+def get_broadcast_progress(conn, job_id):
+    counts = dict(conn.execute('''SELECT status, COUNT(*) FROM broadcast_recipients
+        WHERE job_id = ? GROUP BY status''', (job_id,)).fetchall())
+    return [counts.get(code, 0) for code in range(BC_UNKNOWN + 1)]
+
+
+def get_recent_broadcast_jobs(conn, limit=5):
+    jobs = conn.execute('''SELECT id, preview, status, created_at FROM broadcast_jobs
+        ORDER BY id DESC LIMIT ?''', (limit,)).fetchall()
+    return [(*job, get_broadcast_progress(conn, job[0])) for job in jobs]
+
+
+QUESTIONS_PAGE_SIZE = 5
+QUESTION_PREVIEW_LEN = 500  # вопрос до ~4096 символов; в списке — только начало
+
+
+def get_questions_page(conn, cursor=None, newer=False, limit=QUESTIONS_PAGE_SIZE):
+    """Страница вопросов (от новых к старым) с keyset-пагинацией по (created_at, id).
+
+    cursor — граница соседней страницы: при newer=False берутся вопросы старше
+    нее, при newer=True — новее. Возвращает (rows, has_older, has_newer, total).
+    """
+    select = '''
+        SELECT q.id, q.user_id, q.question_text, q.created_at, u.full_name
         FROM questions q
         LEFT JOIN users u ON q.user_id = u.user_id
-        ORDER BY date DESC
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    '''
+    if cursor is None:
+        rows = conn.execute(select + 'ORDER BY q.created_at DESC, q.id DESC LIMIT ?',
+                            (limit + 1,)).fetchall()
+        has_older, has_newer = len(rows) > limit, False
+    elif newer:
+        rows = conn.execute(select + '''WHERE (q.created_at, q.id) > (?, ?)
+            ORDER BY q.created_at ASC, q.id ASC LIMIT ?''', (*cursor, limit + 1)).fetchall()
+        has_older, has_newer = True, len(rows) > limit
+        rows = rows[:limit][::-1]
+    else:
+        rows = conn.execute(select + '''WHERE (q.created_at, q.id) < (?, ?)
+            ORDER BY q.created_at DESC, q.id DESC LIMIT ?''', (*cursor, limit + 1)).fetchall()
+        has_older, has_newer = len(rows) > limit, True
+    total = conn.execute("SELECT n FROM row_counts WHERE name = 'questions'").fetchone()[0]
+    return rows[:limit], has_older, has_newer, total
 
 
-def delete_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def delete_all_users(conn):
     # Удаляем пользователей из таблиц users и enrollments
-    cursor.execute('DELETE FROM users')
-    cursor.execute('DELETE FROM enrollments')
+    conn.execute('DELETE FROM users')
+    conn.execute('DELETE FROM enrollments')
     conn.commit()
-    conn.close()
 
 
-def delete_all_questions():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM questions')
+def delete_all_questions(conn):
+    conn.execute('DELETE FROM questions')
     conn.commit()
-    conn.close()
+
+
+# --- ХРАНЕНИЕ ВОПРОСОВ ---
+# Отвеченные вопросы удаляются через QUESTIONS_KEEP_ANSWERED_DAYS после ответа.
+# Если вопросов все равно больше QUESTIONS_MAX_ROWS, удаляются самые старые
+# отвеченные. Вопросы без ответа - входящие админа - очистка не трогает, пока
+# явно не задан QUESTIONS_MAX_UNANSWERED. Удаление идет пачками по
+# QUESTIONS_PRUNE_BATCH в отдельных транзакциях, чтобы не держать поток БД.
+QUESTIONS_KEEP_ANSWERED_DAYS = 90
+QUESTIONS_MAX_ROWS = 20000
+QUESTIONS_MAX_UNANSWERED = None  # лимит вопросов без ответа; None - не ограничивать
+QUESTIONS_PRUNE_BATCH = 500
+QUESTIONS_PRUNE_INTERVAL = 6 * 3600  # секунд между проходами очистки
+VACUUM_STEP_PAGES = 1000  # страниц за один шаг incremental_vacuum
+
+
+def prune_answered_questions(conn, answered_before, limit=QUESTIONS_PRUNE_BATCH):
+    with conn:
+        return conn.execute('''DELETE FROM questions WHERE id IN (
+            SELECT id FROM questions WHERE answered_at < ? ORDER BY answered_at LIMIT ?)''',
+                            (answered_before, limit)).rowcount
+
+
+def prune_excess_questions(conn, max_rows=QUESTIONS_MAX_ROWS, limit=QUESTIONS_PRUNE_BATCH):
+    # Только отвеченные: если таблица переполнена вопросами без ответа, лимит не выдерживаем
+    excess = conn.execute("SELECT n FROM row_counts WHERE name = 'questions'").fetchone()[0] - max_rows
+    if excess <= 0:
+        return 0
+    with conn:
+        return conn.execute('''DELETE FROM questions WHERE id IN (
+            SELECT id FROM questions WHERE answered_at IS NOT NULL ORDER BY answered_at LIMIT ?)''',
+                            (min(limit, excess),)).rowcount
+
+
+def prune_unanswered_questions(conn, max_rows, limit=QUESTIONS_PRUNE_BATCH):
+    excess = conn.execute('SELECT COUNT(*) FROM questions WHERE answered_at IS NULL').fetchone()[0] - max_rows
+    if excess <= 0:
+        return 0
+    with conn:
+        return conn.execute('''DELETE FROM questions WHERE id IN (
+            SELECT id FROM questions WHERE answered_at IS NULL ORDER BY created_at, id LIMIT ?)''',
+                            (min(limit, excess),)).rowcount
+
+
+def vacuum_step(conn, pages=VACUUM_STEP_PAGES):
+    # Возвращает свободные страницы файлу; результат pragma нужно дочитать до конца
+    conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+async def prune_questions():
+    removed = 0
+    answered_before = int(time.time()) - QUESTIONS_KEEP_ANSWERED_DAYS * 24 * 3600
+    steps = [(prune_answered_questions, (answered_before,)), (prune_excess_questions, ())]
+    if QUESTIONS_MAX_UNANSWERED is not None:
+        steps.append((prune_unanswered_questions, (QUESTIONS_MAX_UNANSWERED,)))
+    for prune, args in steps:
+        while True:
+            n = await db.run(prune, *args)
+            removed += n
+            if prune is prune_unanswered_questions and n:
+                logging.warning(f"Вопросы: удалено {n} вопросов без ответа (лимит QUESTIONS_MAX_UNANSWERED)")
+            if n < QUESTIONS_PRUNE_BATCH:
+                break
+    if removed:
+        # По шагу за раз: между шагами поток БД обслуживает остальные запросы
+        while await db.run(vacuum_step):
+            pass
+        logging.info(f"Вопросы: удалено по сроку хранения {removed}")
+    return removed
+
+
+async def run_questions_retention():
+    while True:
+        try:
+            await prune_questions()
+        except Exception as e:
+            logging.error(f"Очистка вопросов не удалась: {e}")
+        await asyncio.sleep(QUESTIONS_PRUNE_INTERVAL)
+
+
+class WriteBehind:
+    """Очередь отложенной записи с групповым коммитом.
+
+    Регистрации, записи на курс и вопросы не коммитятся по одной: они
+    копятся в памяти и сбрасываются одной транзакцией каждые `interval`
+    секунд или как только набралось `max_batch` операций. Пока операция
+    не записана, её данные видны через get_user_data (read-your-writes).
+    """
+
+    def __init__(self, database, interval=0.05, max_batch=200, max_attempts=3):
+        self.db = database
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.commits = 0
+        self.written = 0
+        self.dropped = 0
+        self._ops = []
+        # Сколько раз операция уже не записалась: op -> число попыток
+        self._attempts = {}
+        # Еще не закоммиченные данные пользователей: user_id -> args операции
+        self._users = {}
+        self._enrollments = {}
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Не отменяем задачу посреди сброса, а даем ей дописать и выйти
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        if self._task:
+            await self._task
+            self._task = None
+        # Повторы ограничены max_attempts, поэтому цикл конечен
+        while self._ops:
+            await self.flush()
+
+    def save_user(self, user_id, name, info):
+        args = (user_id, name, info)
+        self._users[user_id] = args
+        self._put(save_user, args)
+
+    def mark_reachable(self, user_id):
+        self._put(mark_user_reachable, (user_id,))
+
+    def save_enrollment(self, user_id, course_key):
+        args = (user_id, course_key)
+        self._enrollments[user_id] = args
+        self._put(save_enrollment, args)
+
+    def save_question(self, user_id, text):
+        self._put(save_question, (user_id, text, int(time.time())))
+
+    def mark_answered(self, user_id):
+        # Через ту же очередь: вопрос, еще не сброшенный в БД, тоже закроется
+        self._put(mark_questions_answered, (user_id, int(time.time())))
+
+    def _put(self, fn, args):
+        self._ops.append((fn, args))
+        self._wakeup.set()
+        if len(self._ops) >= self.max_batch:
+            self._full.set()
+
+    async def get_user_data(self, user_id):
+        # Снимок до запроса: если запись успеет закоммититься, БД вернет то же самое
+        user = self._users.get(user_id)
+        enrollment = self._enrollments.get(user_id)
+        data = await self.db.run(get_user_data, user_id)
+        if user is None and enrollment is None:
+            return data
+        full_name, phone, course_key = data if data else (None, None, None)
+        if user is not None:
+            _, full_name, phone = user
+        elif data is None:
+            return None
+        if enrollment is not None:
+            course_key = enrollment[1]
+        return full_name, phone, course_key
+
+    async def flush(self):
+        if not self._ops:
+            return
+        batch, self._ops = self._ops, []
+        self._wakeup.clear()
+        self._full.clear()
+        try:
+            await self.db.run(apply_writes, batch)
+            failed = []
+        except Exception as e:
+            logging.error(f"WriteBehind: не удалось записать {len(batch)} операций: {e}")
+            # Одна плохая операция не должна держать остальные: пишем по одной
+            failed = await self.db.run(apply_writes_each, batch)
+        retry = []
+        for op, e in failed:
+            attempts = self._attempts.get(op, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[op] = attempts
+                retry.append(op)
+            else:
+                self._attempts.pop(op, None)
+                self.dropped += 1
+                logging.error(f"WriteBehind: операция {op[0].__name__}{op[1]} отброшена после {attempts} попыток: {e}")
+        if retry:
+            # Повторим на следующем цикле, раньше новых операций
+            self._ops[:0] = retry
+            self._wakeup.set()
+        self.commits += 1
+        self.written += len(batch) - len(failed)
+        retry_ids = {id(op) for op in retry}
+        for op in batch:
+            if id(op) in retry_ids:
+                continue
+            self._attempts.pop(op, None)
+            fn, args = op
+            overlay = self._users if fn is save_user else self._enrollments if fn is save_enrollment else None
+            # Убираем из overlay только если с тех пор не пришла более новая запись
+            if overlay is not None and overlay.get(args[0]) is args:
+                del overlay[args[0]]
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+
+# --- ХРАНИЛИЩЕ FSM ---
+
+def load_fsm(conn, key, min_updated_at):
+    return conn.execute('SELECT state, data, updated_at FROM fsm WHERE key = ? AND updated_at >= ?',
+                        (key, min_updated_at)).fetchone()
+
+
+def save_fsm_batch(conn, batch):
+    # batch: [(key, state, data_json, updated_at)]; пустое состояние без данных — удаление
+    with conn:
+        conn.executemany('''INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+            updated_at = excluded.updated_at''', [row for row in batch if row[2] is not None])
+        conn.executemany('DELETE FROM fsm WHERE key = ?', [(row[0],) for row in batch if row[2] is None])
+
+
+def expire_fsm(conn, min_updated_at):
+    with conn:
+        return conn.execute('DELETE FROM fsm WHERE updated_at < ?', (min_updated_at,)).rowcount
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в SQLite с ограниченным LRU-кэшем в памяти.
+
+    Изменения копятся в памяти и пишутся в БД пачкой раз в `flush_interval`
+    секунд. Состояния, которые не менялись дольше `ttl` секунд, считаются
+    брошенными и удаляются из кэша и из БД.
+    """
+
+    def __init__(self, database, cache_size=10000, ttl=3 * 24 * 3600, flush_interval=1.0):
+        self.db = database
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # key -> [state, data, updated_at]
+        self._cache = OrderedDict()
+        # key -> (key, state, data_json | None, updated_at) — еще не записано в БД
+        self._dirty = {}
+        self._task = None
+
+    @staticmethod
+    def _key(key):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    async def _entry(self, key):
+        k = self._key(key)
+        stale = self._cache.get(k)
+        now = int(time.time())
+        if stale is not None and stale[2] >= now - self.ttl:
+            self._cache.move_to_end(k)
+            return k, stale
+        pending = self._dirty.get(k)
+        if pending is not None:
+            # Вытеснено из кэша, но еще не записано — берем несохраненную версию
+            row = pending[1:] if pending[2] is not None else None
+        else:
+            row = await self.db.run(load_fsm, k, now - self.ttl)
+        entry = [row[0], json.loads(row[1]), row[2]] if row else [None, {}, now]
+        current = self._cache.get(k)
+        if current is not None and current is not stale:
+            # Пока ждали БД, другой апдейт того же ключа уже создал запись и,
+            # возможно, изменил ее - берем ее, иначе его изменения потеряются
+            entry = current
+        else:
+            self._cache[k] = entry
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return k, entry
+
+    def _mark_dirty(self, k, entry):
+        entry[2] = int(time.time())
+        state, data = entry[0], entry[1]
+        data_json = json.dumps(data, ensure_ascii=False) if state is not None or data else None
+        self._dirty[k] = (k, state, data_json, entry[2])
+
+    async def set_state(self, key, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(k, entry)
+
+    async def get_state(self, key):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key, data):
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._mark_dirty(k, entry)
+
+    async def get_data(self, key):
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch = list(self._dirty.values())
+        self._dirty = {}
+        try:
+            await self.db.run(save_fsm_batch, batch)
+        except Exception as e:
+            logging.error(f"FSM: не удалось записать {len(batch)} состояний: {e}")
+            for row in batch:
+                self._dirty.setdefault(row[0], row)
+
+    async def expire(self):
+        min_updated_at = int(time.time()) - self.ttl
+        for k in [k for k, entry in self._cache.items() if entry[2] < min_updated_at]:
+            del self._cache[k]
+        removed = await self.db.run(expire_fsm, min_updated_at)
+        if removed:
+            logging.info(f"FSM: удалено {removed} брошенных состояний")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_expire > 3600:
+                last_expire = time.monotonic()
+                await self.expire()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+db = Database(DB_NAME)
+writes = WriteBehind(db)
+loop_lag = LoopLagMonitor()
+fsm_storage = SQLiteStorage(db)
 
 
 # --- 3. НАСТРОЙКА БОТА, ТЕКСТЫ И ПРЕДМЕТЫ ---
 
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=fsm_storage)
 bot = Bot(token=API_TOKEN)
 
-STRINGS = {
-    'ru': {
-        'menu': 'Выберите действие:', 'sub': '📚 Курсы', 'reg': '📞 Регистрация',
-        'cab': '👤 Кабинет', 'ask': '❓ Вопрос', 'loc': '📍 Локация', 'res': '🏆 Результаты', 'tst': '📝 Тест',
-        'back': '⬅️ Назад', 'cat': 'Направление:', 'fio': 'Введите ФИО:',
-        'tel': 'Введите телефон (например: +998901234567):',
-        'tel_error': '❌ Неверный формат телефона. Пожалуйста, введите корректный номер, например: +998901234567',
-        'saved': '✅ Сохранено!', 'select_course': 'Выберите направление для записи:',
-        'contact': '📞 Связь',
-
-        'fio_msg_new': 'Введите Ваше полное ФИО для первичной регистрации и записи на курс:',
-        'schedule_header': 'Обзор расписания по курсу:',
-        'reg_complete': 'Регистрация завершена! Вы записаны на курс:',
-        'reg_data_saved': 'Ваши данные сохранены. Теперь выберите курс.'
-    },
-    'uzb': {
-        'menu': "Harakatni tanlang:", 'sub': "📚 Kurslar", 'reg': "📞 Ro'yxatdan o'tish",
-        'cab': "👤 Kabinet", 'ask': "❓ Savol", 'loc': "📍 Manzil", 'res': "🏆 Natijalar", 'tst': "📝 Test",
-        'back': "⬅️ Orqaga", 'cat': "Yo’nalish:", 'fio': "F.I.SH. kiriting:",
-        'tel': "Telefonni kiriting (masalan: +998901234567):",
-        'tel_error': "❌ Noto'g'ri telefon formati. Iltimos, to'g'ri raqam kiriting, masalan: +998901234567",
-        'saved': "✅ Saqlandi!",
-        'loc_text': "📍 Biz bu yerda joylashganmiz (Google Xarita havolasi): [Manzil]",
-        'select_course': "Ro'yxatdan o'tish uchun kursni tanlang:",
-        'contact': "📞 Kontakt",
-
-        'fio_msg_new': "Boshlang'ich ro'yxatdan o'tish va kursga yozilish uchun to'liq F.I.SH.ingizni kiriting:",
-        'schedule_header': "Kurs bo'yicha dars jadvali:",
-        'reg_complete': "Ro'yxatdan o'tish yakunlandi! Siz kursga yozildingiz:",
-        'reg_data_saved': "Ma'lumotlaringiz saqlandi. Endi kursni tanlang."
-    }
-}
-
-SUBJECTS = {
-    "english": {
-        'ru': {'name': "🇬🇧 Английский", 'items': [
-            {"n": "Дина Р.", "t": "Дина Рустамовна",
-             "s": "• Общий курс: Пн/Ср/Пт: 09:30, 14:00, 15:30\n• Общий курс: Вт/Чт/Сб: 09:30, 14:00, 15:30\n• Взрослые: Вечернее время (по договору)"},
-            {"n": "Алина А.", "t": "Алина Алексеевна",
-             "s": "• 5-7 лет: Пн/Ср/Пт 16:30\n• 2-4 классы: Пн/Ср/Пт 14:00\n• 3-4 классы: Вт/Чт/Сб 09:30"},
-            {"n": "IELTS", "t": "Ширин Рустамовна", "s": "• 10-11 классы: Пн/Ср/Пт (время уточняется)"},
-            {"n": "Икболой", "t": "Икболой", "s": "• 4-6 классы: Пн, Ср, Пт 09:00"},
-            {"n": "Дилафруз Ф.", "t": "Дилафруз Фархадовна",
-             "s": "• 3-4 классы: Вт/Чт/Сб 08:30 и 13:30\n• 5-6 классы: Вт/Чт/Сб 15:00"}
-        ]},
-        'uzb': {'name': "🇬🇧 Ingliz tili", 'items': [
-            {"n": "Dina R.", "t": "Dina Rustamovna",
-             "s": "• Umumiy kurs: Du/Cho/Ju: 09:30, 14:00, 15:30\n• Umumiy kurs: Se/Pay/Sha: 09:30, 14:00, 15:30\n• Katta yoshdagilar: Kechki vaqt (so'rov bo'yicha)"},
-            {"n": "Alina A.", "t": "Alina Alekseevna",
-             "s": "• 5-7 yosh: Du/Cho/Ju 16:30\n• 2-4 sinf: Du/Cho/Ju 14:00\n• 3-4 sinf: Se/Pay/Sha 09:30"},
-            {"n": "IELTS", "t": "Shirin Rustamovna", "s": "• 10-11 sinf: Du/Cho/Ju (vaqt aniqlanadi)"},
-            {"n": "Iqboloy", "t": "Iqboloy", "s": "• 4-6 sinf: Du, Cho, Ju 09:00"},
-            {"n": "Dilafruz F.", "t": "Dilafruz Farxadovna",
-             "s": "• 3-4 sinf: Se/Pay/Sha 08:30 va 13:30\n• 5-6 sinf: Se/Pay/Sha 15:00"}
-        ]}
-    },
-    "math": {
-        'ru': {'name': "📐 Математика", 'items': [
-            {"n": "Юрий С.", "t": "Юрий С.", "s": "• 6-11 классы: Вт, Чт 14:00-16:00\n• 2-5 классы: Ср, Сб 14:00-16:00"}
-        ]},
-        'uzb': {'name': "📐 Matematika", 'items': [
-            {"n": "Yuriy S.", "t": "Yuriy S.",
-             "s": "• 6-11 sinf: Se, Pay 14:00-16:00\n• 2-5 sinf: Cho, Sha 14:00-16:00"}
-        ]},
-    },
-    "russian": {
-        'ru': {'name': "🇷🇺 Русский", 'items': [
-            {"n": "Зарина А.", "t": "Зарина А.", "s": "• Групповые занятия (Индивидуально): 16:00"}
-        ]},
-        'uzb': {'name': "🇷🇺 Rus tili", 'items': [
-            {"n": "Zarina A.", "t": "Zarina A.", "s": "• Gruppa darslar (Individual): 16:00"}
-        ]}
-    },
-    "pochemuchka": {
-        'ru': {'name': "👶 Почемучка", 'items': [
-            {"n": "Почемучка", "t": "Алие Ш.", "s": "• Подготовка к школе (русский язык) (5-7 лет): Пн, Ср, Пт 16:30"}
-        ]},
-        'uzb': {'name': '👶 Pochemuchka', 'items': [
-            {"n": "Pochemuchka", "t": "Aliye Sh.",
-             "s": "• Maktabga tayyorlash (Rus Tili) (5-6 yosh): Du, Cho, Ju 16:30"}
-        ]}
-    },
-    "gymnastics": {
-        'ru': {'name': "🤸 ГИМНАСТИКА", 'items': [
-            {"n": "Уточняется", "t": "Тренер", "s": "• Вт, Чт, Сб: время уточняется"}
-        ]},
-        'uzb': {'name': "🤸 GIMNASTIKA", 'items': [
-            {"n": "Anıqlanadi", "t": "Trener", "s": "• Se, Pay, Sha: vaqti aniqlanadi"}
-        ]}
-    },
-    "choreography": {
-        'ru': {'name': "💃 ХОРЕОГРАФИЯ", 'items': [
-            {"n": "Уточняется", "t": "Тренер", "s": "• Даты и время уточняются"}
-        ]},
-        'uzb': {'name': "💃 XOREOGRAFIYA", 'items': [
-            {"n": "Anıqlanadi", "t": "Trener", "s": "• Sanalar va vaqtlar aniqlanadi"}
-        ]}
-    },
-}
+# Тексты, направления с расписанием и вопросы теста живут в Dino Club/content.json
+# (общий файл с bot_app.py). Их подставляет apply_content() при старте и при
+# каждой правке файла, см. content_store ниже.
+STRINGS = {}
+SUBJECTS = {}
+# Вопросы для теста: (текст вопроса, (вариант 1, вариант 2, ...), индекс правильного ответа (начиная с 0))
+ENGLISH_TEST_QUESTIONS = ()
+ENGLISH_TEST_ID = None
 
-# Вопросы для теста: [текст вопроса, [вариант 1, вариант 2, ...], индекс правильного ответа (начиная с 0)]
-ENGLISH_TEST_QUESTIONS = [
-    ["My sister ____ at home now.", ["am", "is", "are", "be"], 1],
-    ["This is ____ car. We drive it every day.", ["I", "our", "their", "she"], 1],
-    ["He always ____ his homework after school.", ["do", "doing", "does", "did"], 2],
-    ["I want to buy ____ umbrella.", ["a", "an", "the", "no article"], 1],
-    ["They ____ to Paris last year.", ["go", "going", "went", "goes"], 2],
-    ["I ____ this film three times already.", ["see", "saw", "have seen", "seeing"], 2],
-    ["You ____ study harder if you want to pass the exam.", ["might", "should", "must", "can"], 1],
-    ["This book is ____ interesting than the last one.", ["many", "much", "more", "most"], 2],
-    ["If it ____ tomorrow, we will stay at home.", ["will rain", "rains", "rained", "raining"], 1],
-    ["The meeting was postponed ____ the manager’s illness.", ["despite", "because", "due to", "although"], 2],
-    ["She avoids ____ late at night.", ["to drive", "drive", "driving", "drove"], 2],
-    ["When the phone ____, I was having dinner.", ["rang", "ring", "was ringing", "has rung"], 0],
-    ["If I had a million dollars, I ____ around the world.", ["will travel", "would travel", "travel", "travelled"],
-     1],
-    ["She has lived in London ____ ten years.", ["since", "for", "on", "at"], 1],
-    ["The new hospital ____ next year.", ["build", "will be built", "is building", "built"], 1],
-]
+# Банки вопросов по id. В FSM теста хранится только id банка и курсор, а не сами
+# вопросы. id вычисляется из содержимого вопросов, а старые банки остаются здесь
+# после перезагрузки контента, поэтому начатые тесты доигрываются по своим ответам.
+TEST_BANKS = {}
 
 
 # --- 4. МАШИНА СОСТОЯНИЙ И КЛАВИАТУРА ---
@@ -302,245 +692,525 @@ class Form(StatesGroup):
     wait_for_admin_answer = State()
 
 
-def main_kb(lang):
-    s = STRINGS[lang]
+# --- ПРОТОКОЛ CALLBACK-КНОПОК ---
+# callback_data = "<код>:<поле>:<поле>...". Код короткий, набор и типы полей
+# для каждого кода зафиксированы в CALLBACK_FIELDS, язык пакуется одной буквой.
+# Все нажатия приходят в один обработчик dispatch_callback: он находит обработчик
+# по коду в словаре (время не растёт с числом экранов), один раз разбирает поля
+# и вызывает handler(c, state, *поля).
+
+LANG_CODES = {'ru': 'r', 'uzb': 'u'}
+LANG_BY_CODE = {code: lang for lang, code in LANG_CODES.items()}
+
+# Тип поля: (упаковка в строку, распаковка из строки)
+FIELD_STR = (str, str)
+FIELD_INT = (str, int)
+FIELD_LANG = (LANG_CODES.__getitem__, LANG_BY_CODE.__getitem__)
+
+CB_MENU = 'l'  # главное меню на выбранном языке
+CB_SUB, CB_REG, CB_CAB, CB_LOC = 'ns', 'nr', 'nc', 'nl'  # разделы главного меню
+CB_RES, CB_TST, CB_ASK, CB_CONTACT = 'nw', 'nt', 'nq', 'nk'
+CB_CAT, CB_DET = 'c', 'd'  # страницы каталога
+CB_COURSE = 'rc'  # выбор курса при регистрации
+CB_TEST_ANS = 't'
+CB_ADMIN, CB_ADMIN_CANCEL, CB_REPLY = 'a', 'ax', 'ar'
+CB_BROADCAST, CB_BC_STATUS, CB_BC_CANCEL = 'ab', 'as', 'ac'
+CB_USERS, CB_USERS_NEXT, CB_USERS_PREV = 'au', 'un', 'up'
+CB_QUESTIONS, CB_Q_OLD, CB_Q_NEW = 'aq', 'qo', 'qn'
+CB_DEL_Q, CB_DEL_Q_OK, CB_DEL_U, CB_DEL_U_OK = 'dq', 'dqy', 'du', 'duy'
+CB_NOOP = 'x'  # кнопка-разделитель
+
+CALLBACK_FIELDS = {
+    CB_MENU: (FIELD_LANG,),
+    CB_SUB: (FIELD_LANG,), CB_REG: (FIELD_LANG,), CB_CAB: (FIELD_LANG,), CB_LOC: (FIELD_LANG,),
+    CB_RES: (FIELD_LANG,), CB_TST: (FIELD_LANG,), CB_ASK: (FIELD_LANG,), CB_CONTACT: (FIELD_LANG,),
+    CB_CAT: (FIELD_STR, FIELD_LANG),  # ключ направления
+    CB_DET: (FIELD_STR, FIELD_INT, FIELD_LANG),  # ключ направления, номер преподавателя
+    CB_COURSE: (FIELD_STR, FIELD_LANG),
+    CB_TEST_ANS: (FIELD_INT, FIELD_INT, FIELD_LANG),  # номер вопроса, номер ответа
+    CB_ADMIN: (), CB_ADMIN_CANCEL: (),
+    CB_REPLY: (FIELD_INT,),  # id пользователя
+    CB_BROADCAST: (), CB_BC_STATUS: (),
+    CB_BC_CANCEL: (FIELD_INT,),  # id рассылки
+    CB_USERS: (),
+    CB_USERS_NEXT: (FIELD_INT,), CB_USERS_PREV: (FIELD_INT,),  # курсор: user_id
+    CB_QUESTIONS: (),
+    CB_Q_OLD: (FIELD_INT, FIELD_INT), CB_Q_NEW: (FIELD_INT, FIELD_INT),  # курсор: (created_at, id)
+    CB_DEL_Q: (), CB_DEL_Q_OK: (), CB_DEL_U: (), CB_DEL_U_OK: (),
+    CB_NOOP: (),
+}
+
+# код -> (обработчик, поля, только для админов, требуемое состояние FSM)
+CALLBACKS = {}
+
+
+def pack(code, *values):
+    return ':'.join([code, *(field[0](v) for field, v in zip(CALLBACK_FIELDS[code], values))])
+
+
+def on_callback(*codes, admin=False, state=None):
+    def register(handler):
+        for code in codes:
+            CALLBACKS[code] = (handler, CALLBACK_FIELDS[code], admin, state.state if state else None)
+        return handler
+    return register
+
+
+@dp.callback_query()
+async def dispatch_callback(c: types.CallbackQuery, state: FSMContext):
+    code, _, packed = (c.data or '').partition(':')
+    entry = CALLBACKS.get(code)
+    args = None
+    if entry is not None:
+        handler, fields, admin_only, need_state = entry
+        values = packed.split(':') if fields else ()
+        if len(values) == len(fields):
+            try:
+                args = [field[1](v) for field, v in zip(fields, values)]
+            except (KeyError, ValueError):
+                pass
+    if args is None:
+        # Кнопка старого формата или от экрана, которого больше нет
+        await c.answer("Кнопка устарела, нажмите /start\nTugma eskirgan, /start ni bosing")
+        return
+    if admin_only and c.from_user.id not in ADMIN_IDS:
+        await c.answer()
+        return
+    if need_state is not None and await state.get_state() != need_state:
+        await c.answer()
+        return
+    await handler(c, state, *args)
+
+
+# --- РЕЕСТР СТАТИЧНЫХ КЛАВИАТУР ---
+# Клавиатуры, которые зависят только от STRINGS/SUBJECTS, собираются один раз
+# (на каждый язык) в build_keyboards() и раздаются всем обработчикам как общие
+# неизменяемые объекты (модели aiogram заморожены). build_keyboards() нужно
+# вызвать заново, только если поменялись тексты или список предметов.
+KEYBOARDS = {}
+
+
+def _button(text, callback_data):
+    return types.InlineKeyboardButton(text=text, callback_data=callback_data)
+
+
+def build_keyboards():
+    global KEYBOARDS
+    kbs = {}
+
     kb = InlineKeyboardBuilder()
-    kb.row(types.InlineKeyboardButton(text=s['sub'], callback_data=f"nav_sub_{lang}"))
-    kb.row(types.InlineKeyboardButton(text=s['reg'], callback_data=f"nav_reg_{lang}"),
-           types.InlineKeyboardButton(text=s['cab'], callback_data=f"nav_cab_{lang}"))
-    kb.row(types.InlineKeyboardButton(text=s['loc'], callback_data=f"nav_loc_{lang}"),
-           types.InlineKeyboardButton(text=s['res'], callback_data=f"nav_res_{lang}"))
-    kb.row(types.InlineKeyboardButton(text=s['tst'], callback_data=f"nav_tst_{lang}"),
-           types.InlineKeyboardButton(text=s['ask'], callback_data=f"nav_ask_{lang}"))
-    kb.row(types.InlineKeyboardButton(text=s['contact'], callback_data=f"nav_contact_{lang}"))
+    kb.add(_button("🇷🇺 Русский", pack(CB_MENU, 'ru')), _button("🇺🇿 O'zbek", pack(CB_MENU, 'uzb')))
+    kbs['lang'] = kb.as_markup()
 
-    return kb.as_markup()
+    for lang, s in STRINGS.items():
+        kb = InlineKeyboardBuilder()
+        kb.row(_button(s['sub'], pack(CB_SUB, lang)))
+        kb.row(_button(s['reg'], pack(CB_REG, lang)), _button(s['cab'], pack(CB_CAB, lang)))
+        kb.row(_button(s['loc'], pack(CB_LOC, lang)), _button(s['res'], pack(CB_RES, lang)))
+        kb.row(_button(s['tst'], pack(CB_TST, lang)), _button(s['ask'], pack(CB_ASK, lang)))
+        kb.row(_button(s['contact'], pack(CB_CONTACT, lang)))
+        kbs['main', lang] = kb.as_markup()
+
+        # Список направлений в разделе "Курсы"
+        kb = InlineKeyboardBuilder()
+        for k in SUBJECTS:
+            kb.row(_button(SUBJECTS[k][lang]['name'], pack(CB_CAT, k, lang)))
+        kb.row(_button(s['back'], pack(CB_MENU, lang)))
+        kbs['subjects', lang] = kb.as_markup()
+
+        # Выбор курса при регистрации
+        kb = InlineKeyboardBuilder()
+        for k in SUBJECTS:
+            kb.row(_button(SUBJECTS[k][lang]['name'], pack(CB_COURSE, k, lang)))
+        kbs['reg_courses', lang] = kb.as_markup()
+
+        kbs['back', lang] = InlineKeyboardBuilder().row(_button(s['back'], pack(CB_MENU, lang))).as_markup()
+
+        kb = InlineKeyboardBuilder()
+        kb.row(_button("✏️ Изменить данные/курс" if lang == 'ru' else "✏️ Ma'lumotlarni/kursni o'zgartirish",
+                       pack(CB_REG, lang)))
+        kb.row(_button(s['back'], pack(CB_MENU, lang)))
+        kbs['cabinet', lang] = kb.as_markup()
+
+    # При отмене, возвращаемся в админ-панель
+    kbs['admin_cancel'] = InlineKeyboardBuilder().add(_button("❌ Отмена", CB_ADMIN)).as_markup()
+
+    kb = InlineKeyboardBuilder()
+    kb.row(_button("💣 Подтвердить удаление пользователей", CB_DEL_U_OK))
+    kb.row(_button("⬅️ Отмена", CB_ADMIN))
+    kbs['confirm_delete', 'users'] = kb.as_markup()
+
+    kb = InlineKeyboardBuilder()
+    kb.row(_button("💣 Подтвердить удаление вопросов", CB_DEL_Q_OK))
+    kb.row(_button("⬅️ Отмена", CB_ADMIN))
+    kbs['confirm_delete', 'questions'] = kb.as_markup()
+
+    kb = InlineKeyboardBuilder()
+    kb.row(_button("👥 Все пользователи", CB_USERS),
+           _button("❓ Все вопросы", CB_QUESTIONS))
+    kb.row(_button("📢 Рассылка", CB_BROADCAST),
+           _button("📊 Статус рассылок", CB_BC_STATUS))
+    kb.row(_button("❌ Удалить все вопросы", CB_DEL_Q),
+           _button("❌ Удалить всех пользователей", CB_DEL_U))
+    kb.row(_button("🔄 Главное меню бота", pack(CB_MENU, 'ru')))
+    kbs['admin_main'] = kb.as_markup()
+
+    kbs['broadcast_status'] = InlineKeyboardBuilder().row(
+        _button("📊 Статус рассылок", CB_BC_STATUS)).as_markup()
+
+    # Подмена целиком: обработчики никогда не видят наполовину собранный реестр
+    KEYBOARDS = kbs
+
+
+def main_kb(lang):
+    return KEYBOARDS['main', lang]
 
 
 def admin_reply_kb(target_user_id: int):
     # Клавиатура для ответа на вопрос
     kb = InlineKeyboardBuilder()
-    kb.add(types.InlineKeyboardButton(text="➡️ Ответить", callback_data=f"admin_reply_{target_user_id}"))
+    kb.add(types.InlineKeyboardButton(text="➡️ Ответить", callback_data=pack(CB_REPLY, target_user_id)))
     return kb.as_markup()
 
 
 def admin_cancel_kb():
-    kb = InlineKeyboardBuilder()
-    # При отмене, возвращаемся в админ-панель
-    kb.add(types.InlineKeyboardButton(text="❌ Отмена", callback_data="admin_panel"))
-    return kb.as_markup()
+    return KEYBOARDS['admin_cancel']
 
 
 def confirm_delete_kb(action_type):
-    kb = InlineKeyboardBuilder()
-    if action_type == 'users':
-        kb.row(types.InlineKeyboardButton(text="💣 Подтвердить удаление пользователей",
-                                          callback_data="admin_delete_users_confirm"))
-    elif action_type == 'questions':
-        kb.row(types.InlineKeyboardButton(text="💣 Подтвердить удаление вопросов",
-                                          callback_data="admin_delete_questions_confirm"))
-    kb.row(types.InlineKeyboardButton(text="⬅️ Отмена", callback_data="admin_panel"))
-    return kb.as_markup()
+    return KEYBOARDS['confirm_delete', action_type]
 
 
 # --- ОБНОВЛЕННАЯ ГЛАВНАЯ АДМИН-КЛАВИАТУРА ---
 def admin_main_kb():
+    return KEYBOARDS['admin_main']
+
+
+def broadcast_status_kb():
+    return KEYBOARDS['broadcast_status']
+
+
+# --- КАТАЛОГ КУРСОВ ---
+# Все страницы каталога (направление и карточка преподавателя на каждом языке)
+# рендерятся заранее вместе с клавиатурами. Ключ - callback_data кнопки, которая
+# ведёт на страницу, значение - (текст, parse_mode, клавиатура).
+CATALOG = {}
+
+
+def render_subject_page(key, lang):
+    s = STRINGS[lang]
+    subj = SUBJECTS[key][lang]
     kb = InlineKeyboardBuilder()
-    kb.row(types.InlineKeyboardButton(text="👥 Все пользователи", callback_data="admin_users_list"),
-           types.InlineKeyboardButton(text="❓ Все вопросы", callback_data="admin_questions_list"))
-    kb.row(types.InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast"))
-    kb.row(types.InlineKeyboardButton(text="❌ Удалить все вопросы", callback_data="admin_delete_questions"),
-           types.InlineKeyboardButton(text="❌ Удалить всех пользователей", callback_data="admin_delete_users"))
-    kb.row(types.InlineKeyboardButton(text="🔄 Главное меню бота", callback_data="lang_ru"))
-    return kb.as_markup()
+
+    text = subj['name']
+
+    if subj['items']:
+        for i, t in enumerate(subj['items']):
+            kb.row(_button(f"👨‍🏫 {t['n']}", pack(CB_DET, key, i, lang)))
+    else:
+        text = (
+            f"По направлению {subj['name']} пока нет данных. Выберите другой язык или направление."
+            if lang == 'ru' else
+            f"{subj['name']} yo'nalishi bo'yicha ma'lumot yo'q. Boshqa yo'nalishni tanlang."
+        )
+
+    kb.row(_button(s['back'], pack(CB_SUB, lang)))
+    return text, None, kb.as_markup()
+
+
+def render_teacher_page(key, idx, lang):
+    it = SUBJECTS[key][lang]['items'][idx]
+
+    if lang == 'ru':
+        text = (
+            f"📖 <b>{it['n']}</b>\n"
+            f"👨‍🏫 Преподаватель: {it['t']}\n"
+            f"<b>⏰ Расписание и классы:</b>\n"
+            f"<pre>{it['s']}</pre>"
+        )
+    else:
+        text = (
+            f"📖 <b>{it['n']}</b>\n"
+            f"👨‍🏫 O'qituvchi: {it['t']}\n"
+            f"<b>⏰ Dars jadvali va sinflar:</b>\n"
+            f"<pre>{it['s']}</pre>"
+        )
+
+    kb = InlineKeyboardBuilder().row(_button(STRINGS[lang]['back'], pack(CB_CAT, key, lang)))
+    return text, "HTML", kb.as_markup()
+
+
+def build_catalog():
+    global CATALOG
+    pages = {}
+    for key, by_lang in SUBJECTS.items():
+        for lang in STRINGS:
+            pages[pack(CB_CAT, key, lang)] = render_subject_page(key, lang)
+            for i in range(len(by_lang[lang]['items'])):
+                pages[pack(CB_DET, key, i, lang)] = render_teacher_page(key, i, lang)
+    CATALOG = pages
+
+
+def apply_content(content):
+    # Вызывается синхронно, без await: обработчики видят либо старый, либо
+    # новый контент вместе с пересобранными клавиатурами и каталогом
+    global STRINGS, SUBJECTS, ENGLISH_TEST_ID, ENGLISH_TEST_QUESTIONS
+    STRINGS = content.strings
+    SUBJECTS = content.subjects
+    ENGLISH_TEST_ID, ENGLISH_TEST_QUESTIONS = content.tests['english']
+    TEST_BANKS[ENGLISH_TEST_ID] = ENGLISH_TEST_QUESTIONS
+    build_keyboards()
+    build_catalog()
+
+
+content_store = ContentStore(apply_content)
+content_store.reload()
 
 
 # --- КОНЕЦ ОБНОВЛЕННОЙ КЛАВИАТУРЫ ---
 
 
+# --- ПОКАЗ ЭКРАНОВ: ПРАВКА ИЛИ НОВОЕ СООБЩЕНИЕ ---
+# Экраны бота по возможности правят сообщение с нажатой кнопкой. show() заранее
+# отсеивает правки, которые Telegram гарантированно отклонит (чужое, нетекстовое
+# или уже недоступное сообщение, тот же текст и клавиатура), и сразу делает
+# нужный вызов вместо пары "упавший edit_text + answer".
+PRESENT_STATS = Counter()  # edited, sent, unchanged, edit_avoided, edit_failed
+PRESENTED_MAX = 10000
+# (chat_id, message_id) -> (text, parse_mode, reply_markup): что бот последним
+# показал в сообщении. Правки сообщений бота должны идти через show(), иначе
+# запись здесь устареет.
+_presented = OrderedDict()
+
+
+def _remember_view(message, view):
+    key = (message.chat.id, message.message_id)
+    _presented[key] = view
+    _presented.move_to_end(key)
+    if len(_presented) > PRESENTED_MAX:
+        _presented.popitem(last=False)
+
+
+def _can_edit(message):
+    # InaccessibleMessage (слишком старое или удалённое) - не types.Message;
+    # edit_text работает только для текстовых сообщений самого бота
+    return (isinstance(message, types.Message) and message.text is not None
+            and message.from_user is not None and message.from_user.id == bot.id)
+
+
+async def show(message, text, reply_markup=None, parse_mode=None, send_new=True):
+    view = (text, parse_mode, reply_markup)
+    if _can_edit(message):
+        shown = _presented.get((message.chat.id, message.message_id))
+        if shown == view or (shown is None and parse_mode is None
+                             and message.text == text and message.reply_markup == reply_markup):
+            PRESENT_STATS['unchanged'] += 1
+            return
+        try:
+            await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                PRESENT_STATS['unchanged'] += 1
+                _remember_view(message, view)
+                return
+            PRESENT_STATS['edit_failed'] += 1
+        else:
+            PRESENT_STATS['edited'] += 1
+            _remember_view(message, view)
+            return
+    else:
+        PRESENT_STATS['edit_avoided'] += 1
+    if not send_new:
+        return
+    sent = await message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    PRESENT_STATS['sent'] += 1
+    if isinstance(sent, types.Message):
+        _remember_view(sent, view)
+
+
 # --- 5. ОБРАБОТЧИКИ БОТА (ЛОГИКА) ---
 
 @dp.message(Command("start"))
 async def start(m: types.Message):
-    kb = InlineKeyboardBuilder()
-    kb.add(types.InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang_ru"),
-           types.InlineKeyboardButton(text="🇺🇿 O'zbek", callback_data="lang_uzb"))
-    await m.answer("Выберите язык / Tilni tanlang:", reply_markup=kb.as_markup())
+    writes.mark_reachable(m.from_user.id)
+    await m.answer("Выберите язык / Tilni tanlang:", reply_markup=KEYBOARDS['lang'])
 
 
-@dp.callback_query(F.data.startswith("lang_"))
-async def set_lang(c: types.CallbackQuery, state: FSMContext):
+@on_callback(CB_MENU)
+async def set_lang(c: types.CallbackQuery, state: FSMContext, lang):
     await c.answer()
-    lang = c.data.split("_")[1]
 
     await state.clear()
 
-    try:
-        await c.message.edit_text(STRINGS[lang]['menu'], reply_markup=main_kb(lang))
-    except TelegramBadRequest:
-        await c.message.answer(STRINGS[lang]['menu'], reply_markup=main_kb(lang))
+    await show(c.message, STRINGS[lang]['menu'], reply_markup=main_kb(lang))
+
 
+# --- РАЗДЕЛЫ ГЛАВНОГО МЕНЮ ---
 
-@dp.callback_query(F.data.startswith("nav_"))
-async def route(c: types.CallbackQuery, state: FSMContext):
+@on_callback(CB_REG)
+async def nav_reg(c: types.CallbackQuery, state: FSMContext, lang):
     await c.answer()
     await state.clear()
-    _, act, lang = c.data.split("_")
     s = STRINGS[lang]
 
-    # --- ЛОГИКА РЕГИСТРАЦИИ (nav_reg) ---
-    if act == "reg":
-        prompt_text = s['fio_msg_new']
+    prompt_text = s['fio_msg_new']
 
-        await state.update_data(l=lang, reg_type='new')
+    await state.update_data(l=lang, reg_type='new')
 
-        try:
-            await c.message.edit_text(prompt_text)
-        except TelegramBadRequest:
-            await c.message.answer(prompt_text)
+    await show(c.message, prompt_text)
 
-        await state.set_state(Form.name)
-    # --- КОНЕЦ ЛОГИКИ РЕГИСТРАЦИИ ---
+    await state.set_state(Form.name)
 
-    elif act == "sub":
-        kb = InlineKeyboardBuilder()
-        for k in SUBJECTS:
-            kb.row(types.InlineKeyboardButton(text=SUBJECTS[k][lang]['name'], callback_data=f"cat_{k}_{lang}"))
-        kb.row(types.InlineKeyboardButton(text=s['back'], callback_data=f"lang_{lang}"))
-        try:
-            await c.message.edit_text(s['cat'], reply_markup=kb.as_markup())
-        except TelegramBadRequest:
-            await c.message.answer(s['cat'], reply_markup=kb.as_markup())
 
-    elif act == "loc":
-        try:
-            await bot.send_location(c.message.chat.id,
-                                    latitude=LOCATION_COORDS['latitude'],
-                                    longitude=LOCATION_COORDS['longitude'])
-        except Exception as e:
-            logging.error(f"Failed to send location: {e}")
+@on_callback(CB_SUB)
+async def nav_sub(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
+    s = STRINGS[lang]
 
-        maps_link = f"https://maps.app.goo.gl/6CfCKHuA9mwp4m5C9?q={LOCATION_COORDS['latitude']},{LOCATION_COORDS['longitude']}"
-        text = (
-            "📍 **Мы находимся здесь:**\n"
-            f"[Открыть в Google Maps]({maps_link})" if lang == 'ru' else
-            "📍 **Biz bu yerda joylashganmiz:**\n"
-            f"[Google Xaritada ochish]({maps_link})"
-        )
-        await c.message.answer(text, parse_mode="Markdown", reply_markup=main_kb(lang))
+    kb = KEYBOARDS['subjects', lang]
+    await show(c.message, s['cat'], reply_markup=kb)
 
-    elif act == "ask":
-        await state.update_data(l=lang)
-        # --- ИЗМЕНЕНИЕ 1: Удаление "анонимный/Anonim" из пользовательского запроса ---
-        await c.message.answer(
-            "❓ Введите ваш вопрос:" if lang == 'ru' else "❓ Savolingizni kiriting:")
-        # --- КОНЕЦ ИЗМЕНЕНИЯ 1 ---
-        await state.set_state(Form.ask_q)
 
-    elif act == "res":
-        await c.message.answer(
-            "🏆 Результаты учеников и достижения: скоро здесь!" if lang == 'ru' else "🏆 O'quvchilar natijalari va yutuqlari: tez orada shu yerda bo'ladi!",
-            reply_markup=main_kb(lang))
+@on_callback(CB_LOC)
+async def nav_loc(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
 
-    # --- ЛОГИКА ТЕСТА (nav_tst) ---
-    elif act == "tst":
-        await state.clear()
+    try:
+        await bot.send_location(c.message.chat.id,
+                                latitude=LOCATION_COORDS['latitude'],
+                                longitude=LOCATION_COORDS['longitude'])
+    except Exception as e:
+        logging.error(f"Failed to send location: {e}")
+
+    maps_link = f"https://maps.app.goo.gl/6CfCKHuA9mwp4m5C9?q={LOCATION_COORDS['latitude']},{LOCATION_COORDS['longitude']}"
+    text = (
+        "📍 **Мы находимся здесь:**\n"
+        f"[Открыть в Google Maps]({maps_link})" if lang == 'ru' else
+        "📍 **Biz bu yerda joylashganmiz:**\n"
+        f"[Google Xaritada ochish]({maps_link})"
+    )
+    await c.message.answer(text, parse_mode="Markdown", reply_markup=main_kb(lang))
 
-        await state.update_data(
-            l=lang,
-            test_score=0,
-            question_index=0,
-            test_questions=ENGLISH_TEST_QUESTIONS
-        )
-        intro_text = (
-            "📝 **Начинаем тест на определение уровня английского языка!**\n\n_Выберите один правильный вариант ответа._" if lang == 'ru' else
-            "📝 **Ingliz tili darajasini aniqlash testini boshlaymiz!**\n\n_Bitta to'g'ri javobni tanlang._")
 
-        try:
-            await c.message.edit_text(intro_text, parse_mode="Markdown")
-        except TelegramBadRequest:
-            await c.message.answer(intro_text, parse_mode="Markdown")
+@on_callback(CB_ASK)
+async def nav_ask(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
 
-        await state.set_state(Form.test_q)
+    await state.update_data(l=lang)
+    # --- ИЗМЕНЕНИЕ 1: Удаление "анонимный/Anonim" из пользовательского запроса ---
+    await c.message.answer(
+        "❓ Введите ваш вопрос:" if lang == 'ru' else "❓ Savolingizni kiriting:")
+    # --- КОНЕЦ ИЗМЕНЕНИЯ 1 ---
+    await state.set_state(Form.ask_q)
 
-        await ask_test_question(c.message, state)
 
-    elif act == "contact":
-        text = (
-            "📞 **Связь с администрацией DINO CLUB**\n\n" if lang == 'ru' else
-            "📞 **DINO CLUB ma'muriyati bilan bog'lanish**\n\n"
-        )
-        text += (
-            "По всем вопросам записи, расписания и оплаты:\n\n" if lang == 'ru' else
-            "Ro'yxatdan o'tish, dars jadvali va to'lov masalalari bo'yicha:\n\n"
-        )
-        admin_link = f"https://t.me/{ADMIN_USERNAME.strip('@')}"
-        text += f"👤 **Telegram:** [{ADMIN_USERNAME}]({admin_link})\n"
+@on_callback(CB_RES)
+async def nav_res(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
 
-        for i, phone in enumerate(CONTACT_PHONES, 1):
-            text += f"📱 **Телефон {i}:** [{phone}](tel:{phone.strip('+')})\n"
+    await c.message.answer(
+        "🏆 Результаты учеников и достижения: скоро здесь!" if lang == 'ru' else "🏆 O'quvchilar natijalari va yutuqlari: tez orada shu yerda bo'ladi!",
+        reply_markup=main_kb(lang))
 
-        text += "\nМы рады вам помочь!" if lang == 'ru' else "\nSizga yordam berishdan mamnunmiz!"
 
-        kb = InlineKeyboardBuilder().row(
-            types.InlineKeyboardButton(text=s['back'], callback_data=f"lang_{lang}")).as_markup()
+@on_callback(CB_TST)
+async def nav_tst(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
 
-        try:
-            await c.message.edit_text(text, parse_mode="Markdown", reply_markup=kb)
-        except TelegramBadRequest:
-            await c.message.answer(text, parse_mode="Markdown", reply_markup=kb)
+    # tb — id банка вопросов, ti — номер текущего вопроса, ts — счет,
+    # ta — битовая маска правильных ответов (бит i — вопрос i)
+    data = await state.update_data(l=lang, tb=ENGLISH_TEST_ID, ti=0, ts=0, ta=0)
+    intro_text = (
+        "📝 **Начинаем тест на определение уровня английского языка!**\n\n_Выберите один правильный вариант ответа._" if lang == 'ru' else
+        "📝 **Ingliz tili darajasini aniqlash testini boshlaymiz!**\n\n_Bitta to'g'ri javobni tanlang._")
 
-    elif act == "cab":
-        user_data = await asyncio.to_thread(get_user_data, c.from_user.id)
+    await show(c.message, intro_text, parse_mode="Markdown")
 
-        if not user_data:
-            await c.message.answer(
-                "❌ Вы еще не зарегистрированы. Нажмите '📞 Регистрация'." if lang == 'ru' else f"❌ Siz hali ro'yxatdan o'tmagansiz. '{s['reg']}' tugmasini bosing.",
-                reply_markup=main_kb(lang))
-            return
+    await state.set_state(Form.test_q)
 
-        full_name, phone, course_key = user_data
+    await ask_test_question(c.message, state, data)
 
-        if lang == 'ru':
-            text = f"👤 <b>Ваш Личный Кабинет</b>\n\nИмя: {full_name}\nТелефон: {phone}\n"
-            button_text = "✏️ Изменить данные/курс"
-            not_selected = "❌ Не выбран"
-            select_prompt = "Для выбора курса нажмите '✏️ Изменить данные/курс'."
 
-        else:  # uzb
-            text = f"👤 <b>Sizning shaxsiy kabinetingiz</b>\n\nIsm: {full_name}\nTelefon: {phone}\n"
-            button_text = "✏️ Ma'lumotlarni/kursni o'zgartirish"
-            not_selected = "❌ Tanlanmagan"
-            select_prompt = "Kursni tanlash uchun '✏️ Ma'lumotlarni/kursni o'zgartirish' tugmasini bosing."
+@on_callback(CB_CONTACT)
+async def nav_contact(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
 
-        if course_key and course_key in SUBJECTS:
-            course_name = SUBJECTS[course_key][lang]['name']
+    text = (
+        "📞 **Связь с администрацией DINO CLUB**\n\n" if lang == 'ru' else
+        "📞 **DINO CLUB ma'muriyati bilan bog'lanish**\n\n"
+    )
+    text += (
+        "По всем вопросам записи, расписания и оплаты:\n\n" if lang == 'ru' else
+        "Ro'yxatdan o'tish, dars jadvali va to'lov masalalari bo'yicha:\n\n"
+    )
+    admin_link = f"https://t.me/{ADMIN_USERNAME.strip('@')}"
+    text += f"👤 **Telegram:** [{ADMIN_USERNAME}]({admin_link})\n"
 
-            course_text = "Ваш курс:" if lang == 'ru' else "Sizning kursingiz:"
-            text += f"\n{course_text} <b>{course_name}</b>\n"
+    for i, phone in enumerate(CONTACT_PHONES, 1):
+        text += f"📱 **Телефон {i}:** [{phone}](tel:{phone.strip('+')})\n"
 
-            try:
-                # Берем расписание первого преподавателя в списке
-                schedule = SUBJECTS[course_key][lang]['items'][0]['s']
+    text += "\nМы рады вам помочь!" if lang == 'ru' else "\nSizga yordam berishdan mamnunmiz!"
 
-                schedule_header = STRINGS[lang]['schedule_header']
+    kb = KEYBOARDS['back', lang]
 
-                text += f"{schedule_header}\n<pre>{schedule}</pre>"
-            except (IndexError, KeyError):
-                text += ("Расписание пока не найдено." if lang == 'ru' else "Dars jadvali topilmadi.")
-        else:
-            course_text = "Ваш курс:" if lang == 'ru' else "Sizning kursingiz:"
-            text += f"\n{course_text} {not_selected}\n"
-            text += select_prompt
+    await show(c.message, text, parse_mode="Markdown", reply_markup=kb)
 
-        kb = InlineKeyboardBuilder()
-        kb.row(types.InlineKeyboardButton(text=button_text, callback_data=f"nav_reg_{lang}"))
-        kb.row(types.InlineKeyboardButton(text=s['back'], callback_data=f"lang_{lang}"))
+
+@on_callback(CB_CAB)
+async def nav_cab(c: types.CallbackQuery, state: FSMContext, lang):
+    await c.answer()
+    await state.clear()
+    s = STRINGS[lang]
+
+    user_data = await writes.get_user_data(c.from_user.id)
+
+    if not user_data:
+        await c.message.answer(
+            "❌ Вы еще не зарегистрированы. Нажмите '📞 Регистрация'." if lang == 'ru' else f"❌ Siz hali ro'yxatdan o'tmagansiz. '{s['reg']}' tugmasini bosing.",
+            reply_markup=main_kb(lang))
+        return
+
+    full_name, phone, course_key = user_data
+
+    if lang == 'ru':
+        text = f"👤 <b>Ваш Личный Кабинет</b>\n\nИмя: {full_name}\nТелефон: {phone}\n"
+        not_selected = "❌ Не выбран"
+        select_prompt = "Для выбора курса нажмите '✏️ Изменить данные/курс'."
+
+    else:  # uzb
+        text = f"👤 <b>Sizning shaxsiy kabinetingiz</b>\n\nIsm: {full_name}\nTelefon: {phone}\n"
+        not_selected = "❌ Tanlanmagan"
+        select_prompt = "Kursni tanlash uchun '✏️ Ma'lumotlarni/kursni o'zgartirish' tugmasini bosing."
+
+    if course_key and course_key in SUBJECTS:
+        course_name = SUBJECTS[course_key][lang]['name']
+
+        course_text = "Ваш курс:" if lang == 'ru' else "Sizning kursingiz:"
+        text += f"\n{course_text} <b>{course_name}</b>\n"
 
         try:
-            await c.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
-        except TelegramBadRequest:
-            await c.message.answer(text, parse_mode="HTML", reply_markup=kb.as_markup())
+            # Берем расписание первого преподавателя в списке
+            schedule = SUBJECTS[course_key][lang]['items'][0]['s']
+
+            schedule_header = STRINGS[lang]['schedule_header']
+
+            text += f"{schedule_header}\n<pre>{schedule}</pre>"
+        except (IndexError, KeyError):
+            text += ("Расписание пока не найдено." if lang == 'ru' else "Dars jadvali topilmadi.")
+    else:
+        course_text = "Ваш курс:" if lang == 'ru' else "Sizning kursingiz:"
+        text += f"\n{course_text} {not_selected}\n"
+        text += select_prompt
+
+    kb = KEYBOARDS['cabinet', lang]
+
+    await show(c.message, text, parse_mode="HTML", reply_markup=kb)
 
 
 @dp.message(Form.name)
@@ -563,63 +1233,53 @@ async def get_phone(m: types.Message, state: FSMContext):
         await m.answer(s['tel_error'])
         return
 
-    await asyncio.to_thread(save_user, m.from_user.id, data['n'], m.text)
+    writes.save_user(m.from_user.id, data['n'], m.text)
 
     reg_status_ru = "НОВЫЙ КАНДИДАТ / ОБНОВЛЕНИЕ ДАННЫХ"
 
-    # Уведомление администратору
-    try:
-        await bot.send_message(
-            NOTIFICATION_ADMIN_ID,
-            f"🔔 НОВЫЙ ВВОД ДАННЫХ ({reg_status_ru}):\n"
-            f"ФИО: {data['n']}\n"
-            f"Телефон: {m.text}",
-            parse_mode="Markdown"
-        )
-    except (TelegramBadRequest, TelegramForbiddenError) as e:
-        logging.error(f"Failed to send admin notification: {e}")
-
-    kb = InlineKeyboardBuilder()
-    for k in SUBJECTS:
-        kb.row(types.InlineKeyboardButton(text=SUBJECTS[k][lang]['name'], callback_data=f"reg_course_{k}_{lang}"))
+    # Уведомление администратору (доставляется в фоне, пользователь не ждет)
+    notifier.notify(
+        'registration',
+        f"🔔 НОВЫЙ ВВОД ДАННЫХ ({reg_status_ru}):\n"
+        f"ФИО: {data['n']}\n"
+        f"Телефон: {m.text}",
+        parse_mode="Markdown"
+    )
 
     await m.answer(s['reg_data_saved'])
-    await m.answer(s['select_course'], reply_markup=kb.as_markup())
+    await m.answer(s['select_course'], reply_markup=KEYBOARDS['reg_courses', lang])
     await state.set_state(Form.select_course)
 
 
-@dp.callback_query(F.data.startswith("reg_course_"), Form.select_course)
-async def enroll_course(c: types.CallbackQuery, state: FSMContext):
+@on_callback(CB_COURSE, state=Form.select_course)
+async def enroll_course(c: types.CallbackQuery, state: FSMContext, course_key, lang):
     await c.answer()
-    _, _, course_key, lang = c.data.split("_")
     s = STRINGS[lang]
+    if course_key not in SUBJECTS:
+        # Кнопка от старой версии контента: направление уже убрали
+        await c.message.answer(s['select_course'], reply_markup=KEYBOARDS['reg_courses', lang])
+        return
 
-    await asyncio.to_thread(save_enrollment, c.from_user.id, course_key)
+    writes.save_enrollment(c.from_user.id, course_key)
 
     course_name = SUBJECTS[course_key][lang]['name']
 
-    user_data = await asyncio.to_thread(get_user_data, c.from_user.id)
+    user_data = await writes.get_user_data(c.from_user.id)
     name, phone, _ = user_data if user_data else ("Неизвестно", "Неизвестно", None)
 
     # Уведомление администратору
-    try:
-        await bot.send_message(
-            NOTIFICATION_ADMIN_ID,
-            f"✅ **КУРС ОБНОВЛЕН/ЗАПИСЬ:**\n"
-            f"Пользователь: {name} (ID: `{c.from_user.id}`)\n"
-            f"Телефон: {phone}\n"
-            f"Курс: **{course_name}**",
-            parse_mode="Markdown")
-    except (TelegramBadRequest, TelegramForbiddenError) as e:
-        logging.error(f"Failed to send admin notification: {e}")
+    notifier.notify(
+        'enrollment',
+        f"✅ **КУРС ОБНОВЛЕН/ЗАПИСЬ:**\n"
+        f"Пользователь: {name} (ID: `{c.from_user.id}`)\n"
+        f"Телефон: {phone}\n"
+        f"Курс: **{course_name}**",
+        parse_mode="Markdown")
 
     reg_complete_text = s['reg_complete']
     text = f"✅ {reg_complete_text} <b>{course_name}</b>."
 
-    try:
-        await c.message.edit_text(text, parse_mode="HTML", reply_markup=main_kb(lang))
-    except TelegramBadRequest:
-        await c.message.answer(text, parse_mode="HTML", reply_markup=main_kb(lang))
+    await show(c.message, text, parse_mode="HTML", reply_markup=main_kb(lang))
 
     await state.clear()
 
@@ -628,26 +1288,23 @@ async def enroll_course(c: types.CallbackQuery, state: FSMContext):
 
 @dp.message(Form.ask_q)
 async def process_ask(m: types.Message, state: FSMContext):
-    await asyncio.to_thread(save_question, m.from_user.id, m.text)
+    writes.save_question(m.from_user.id, m.text)
 
-    user_info = await asyncio.to_thread(get_user_data, m.from_user.id)
+    user_info = await writes.get_user_data(m.from_user.id)
     name = user_info[0] if user_info else "Неизвестный пользователь"
 
     target_id = m.from_user.id
 
     # Уведомление администратору (С КНОПКОЙ ОТВЕТА)
     # --- ИЗМЕНЕНИЕ 2: Удаление "(АННОНИМНО)" из уведомления администратору ---
-    try:
-        await bot.send_message(
-            NOTIFICATION_ADMIN_ID,
-            f"❓ **НОВЫЙ ВОПРОС:**\n"
-            f"От: {name} (ID: `{target_id}`)\n"
-            f"Текст: {m.text}",
-            parse_mode="Markdown",
-            reply_markup=admin_reply_kb(target_id)
-        )
-    except (TelegramBadRequest, TelegramForbiddenError) as e:
-        logging.error(f"Failed to send admin notification: {e}")
+    notifier.notify(
+        'question',
+        f"❓ **НОВЫЙ ВОПРОС:**\n"
+        f"От: {name} (ID: `{target_id}`)\n"
+        f"Текст: {m.text}",
+        parse_mode="Markdown",
+        reply_markup=admin_reply_kb(target_id)
+    )
     # --- КОНЕЦ ИЗМЕНЕНИЯ 2 ---
 
     lang = (await state.get_data())['l']
@@ -664,25 +1321,313 @@ async def admin_panel_cmd(m: types.Message):
     await m.answer("⚙️ **Админ-панель**", reply_markup=admin_main_kb(), parse_mode="Markdown")
 
 
-@dp.callback_query(F.data == "admin_panel", F.from_user.id.in_(ADMIN_IDS))
+@on_callback(CB_ADMIN, admin=True)
 async def admin_panel_cb(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
     await state.clear()
+    await show(c.message, "⚙️ **Админ-панель**", reply_markup=admin_main_kb(), parse_mode="Markdown")
+
+
+# --- ДВИЖОК РАССЫЛКИ ---
+
+# Telegram допускает ~30 сообщений в секунду от одного бота; держимся чуть ниже
+BROADCAST_RATE = 25
+BROADCAST_BURST = 3
+BROADCAST_WORKERS = 10
+BROADCAST_MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """Общий для всех отправителей лимит скорости (token bucket).
+
+    pause() останавливает выдачу токенов всем сразу — так обрабатывается
+    TelegramRetryAfter, который относится ко всему боту, а не к одному чату.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        # Лок держится и во время ожидания: токены выдаются строго по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def broadcast(user_ids, send, on_result=None, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS):
+    """Отправляет send(user_id) всем получателям пулом из `workers` отправителей.
+
+    user_ids — обычный или асинхронный итератор: получатели читаются по мере
+    отправки, а не загружаются в память целиком.
+
+    Скорость ограничена общим TokenBucket. На TelegramRetryAfter вся рассылка
+    ждет указанное время, и тот же получатель пробуется снова. Результат
+    каждого получателя ('sent', 'blocked', 'deactivated', 'failed') передается в
+    on_result(user_id, outcome). Возвращает счетчики по исходам.
+    """
+    bucket = TokenBucket(rate, BROADCAST_BURST)
+    queue = asyncio.Queue(maxsize=workers * 2)
+    stats = {'sent': 0, 'blocked': 0, 'deactivated': 0, 'failed': 0}
+
+    async def deliver(user_id):
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                await send(user_id)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                logging.warning(f"Рассылка: flood wait {e.retry_after}с (получатель {user_id})")
+                bucket.pause(e.retry_after)
+            except TelegramForbiddenError as e:
+                return 'deactivated' if 'deactivated' in e.message else 'blocked'
+            except TelegramBadRequest as e:
+                logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                return 'failed'
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Рассылка: временная ошибка для {user_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            outcome = await deliver(user_id)
+            stats[outcome] += 1
+            if on_result:
+                on_result(user_id, outcome)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
     try:
-        await c.message.edit_text("⚙️ **Админ-панель**", reply_markup=admin_main_kb(), parse_mode="Markdown")
-    except TelegramBadRequest:
-        await c.message.answer("⚙️ **Админ-панель**", reply_markup=admin_main_kb(), parse_mode="Markdown")
+        if hasattr(user_ids, '__aiter__'):
+            async for user_id in user_ids:
+                await queue.put(user_id)
+        else:
+            for user_id in user_ids:
+                await queue.put(user_id)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return stats
+
+
+# --- УВЕДОМЛЕНИЯ АДМИНИСТРАТОРУ ---
+
+NOTIFY_QUEUE_SIZE = 1000  # максимум ожидающих уведомлений на один чат
+NOTIFY_RATE = 5  # сообщений в секунду на все уведомления
+NOTIFY_PARALLEL = 4  # запросов к Telegram одновременно на все чаты
+# Админ заблокировал бота — столько секунд не пытаемся ему писать
+NOTIFY_BLOCKED_COOLDOWN = 600
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_DRAIN_TIMEOUT = 5  # секунд на досылку очереди при остановке
+# Один чат получает не больше одного сообщения за окно: всё, что пришло за это
+# время, уходит одной сводкой. Первое уведомление после паузы уходит сразу.
+NOTIFY_COALESCE_WINDOW = 3.0
+NOTIFY_DIGEST_MAX = 10  # уведомлений в одной сводке
+NOTIFY_MESSAGE_LEN = 4096  # лимит Telegram на длину сообщения
+
+
+def build_digest(items):
+    """Склеивает уведомления с одинаковым parse_mode в одно сообщение.
+
+    Уведомления нумеруются, кнопки каждого уведомления сохраняются, а к их
+    тексту добавляется тот же номер, чтобы было видно, к чему они относятся.
+    """
+    if len(items) == 1:
+        return items[0]
+    parse_mode = items[0][1]
+    header = f"📬 **Сводка уведомлений ({len(items)}):**" if parse_mode == "Markdown" else \
+        f"📬 Сводка уведомлений ({len(items)}):"
+    parts = [header]
+    rows = []
+    for i, (text, _, reply_markup) in enumerate(items, 1):
+        parts.append(f"{i}. {text}")
+        if reply_markup:
+            for row in reply_markup.inline_keyboard:
+                rows.append([button.model_copy(update={'text': f"{i}. {button.text}"}) for button in row])
+    reply_markup = types.InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+    return "\n\n".join(parts), parse_mode, reply_markup
+
+
+class Notifier:
+    """Исходящие уведомления администраторам с доставкой в фоне.
+
+    Обработчики пользователей кладут уведомление в очередь через notify() и
+    сразу отвечают пользователю. Уведомление раскладывается по почтовым
+    ящикам всех админов из NOTIFY_ROUTES для его типа. У каждого чата свой
+    фоновый отправитель, отправители работают параллельно (не больше
+    NOTIFY_PARALLEL запросов сразу), так что медленный или заблокировавший
+    бота админ не задерживает остальных. Каждый отправитель шлет не чаще
+    раза в NOTIFY_COALESCE_WINDOW и склеивает накопившиеся за это время
+    уведомления в сводку (build_digest), поэтому в сезон записи
+    число сообщений администратору растет медленнее числа событий.
+    Временные ошибки повторяются с паузой. TelegramRetryAfter ставит на
+    паузу только чат, для которого он пришел; общий TokenBucket лишь
+    ограничивает суммарную скорость.
+    """
+
+    def __init__(self, maxsize=NOTIFY_QUEUE_SIZE, rate=NOTIFY_RATE, window=NOTIFY_COALESCE_WINDOW,
+                 parallel=NOTIFY_PARALLEL, routes=NOTIFY_ROUTES):
+        self.maxsize = maxsize
+        self.window = window
+        self.routes = routes
+        # queued/sent/failed/dropped — уведомления, messages — отправленные сообщения
+        self.stats = Counter()
+        self.chat_stats = {}  # chat_id -> Counter sent/failed/dropped
+        self._bucket = TokenBucket(rate)
+        self._slots = asyncio.Semaphore(parallel)
+        self._blocked_until = {}  # chat_id -> time.monotonic(), до которого не пишем
+        self._flood_until = {}  # chat_id -> time.monotonic() конца flood wait этого чата
+        self._mailboxes = {}  # chat_id -> deque ожидающих (text, parse_mode, reply_markup)
+        self._senders = {}  # chat_id -> задача-отправитель
+        self._last_sent = {}  # chat_id -> time.monotonic() последней отправки
+        self._pending = 0
+        self._closing = False
+
+    def notify(self, event, text, parse_mode=None, reply_markup=None):
+        for chat_id in self.routes.get(event, ADMIN_IDS):
+            self._enqueue(chat_id, (text, parse_mode, reply_markup))
+
+    def _count(self, chat_id, key, n=1):
+        self.stats[key] += n
+        self.chat_stats.setdefault(chat_id, Counter())[key] += n
+
+    def _enqueue(self, chat_id, item):
+        # Лимит на чат: ящик заблокированного админа не вытесняет остальных
+        mailbox = self._mailboxes.setdefault(chat_id, deque())
+        if len(mailbox) >= self.maxsize:
+            self._count(chat_id, 'dropped')
+            logging.error(f"Очередь уведомлений для {chat_id} переполнена, уведомление потеряно: {item[0][:100]}")
+            return
+        mailbox.append(item)
+        self._pending += 1
+        self.stats['queued'] += 1
+        if chat_id not in self._senders:
+            self._senders[chat_id] = asyncio.create_task(self._sender(chat_id))
+
+    def pending(self):
+        return self._pending
+
+    async def close(self, timeout=NOTIFY_DRAIN_TIMEOUT):
+        # Досылаем накопленное без ожидания окна, но не дольше timeout
+        self._closing = True
+        senders = list(self._senders.values())
+        if senders:
+            done, not_done = await asyncio.wait(senders, timeout=timeout)
+            if not_done:
+                logging.warning(f"Остановка: не доставлено уведомлений: {self._pending}")
+                for task in not_done:
+                    task.cancel()
+                await asyncio.gather(*not_done, return_exceptions=True)
+
+    def _take_batch(self, mailbox):
+        # Подряд идущие уведомления с одним parse_mode, пока сводка влезает в сообщение
+        batch = [mailbox.popleft()]
+        size = len(batch[0][0])
+        while mailbox and len(batch) < NOTIFY_DIGEST_MAX:
+            text, parse_mode, _ = mailbox[0]
+            size += len(text) + 8
+            if parse_mode != batch[0][1] or size > NOTIFY_MESSAGE_LEN - 100:
+                break
+            batch.append(mailbox.popleft())
+        return batch
+
+    async def _sender(self, chat_id):
+        mailbox = self._mailboxes[chat_id]
+        try:
+            while mailbox:
+                wait = self._last_sent.get(chat_id, 0) + self.window - time.monotonic()
+                if wait > 0 and not self._closing:
+                    await asyncio.sleep(wait)
+                batch = self._take_batch(mailbox)
+                self._pending -= len(batch)
+                if self._blocked_until.get(chat_id, 0) > time.monotonic():
+                    self._count(chat_id, 'failed', len(batch))
+                    continue
+                delivered = await self._deliver(chat_id, *build_digest(batch))
+                self._last_sent[chat_id] = time.monotonic()
+                self._count(chat_id, 'sent' if delivered else 'failed', len(batch))
+                self.stats['messages'] += delivered
+        finally:
+            self._pending -= len(mailbox)
+            del self._senders[chat_id]
+            del self._mailboxes[chat_id]
+
+    async def _deliver(self, chat_id, text, parse_mode, reply_markup):
+        for attempt in range(NOTIFY_MAX_ATTEMPTS):
+            # Flood wait ждет только отправитель этого чата, остальные админы не стоят
+            wait = self._flood_until.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._bucket.acquire()
+            try:
+                # Слот держим только на время запроса, паузы между попытками идут без него
+                async with self._slots:
+                    await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+                return True
+            except TelegramRetryAfter as e:
+                logging.warning(f"Уведомления: flood wait {e.retry_after}с для {chat_id}")
+                self._flood_until[chat_id] = time.monotonic() + e.retry_after
+            except TelegramBadRequest as e:
+                if parse_mode and "can't parse entities" in e.message:
+                    # Текст пользователя сломал разметку — отправляем как есть
+                    parse_mode = None
+                    continue
+                logging.error(f"Failed to send admin notification: {e}")
+                return False
+            except TelegramForbiddenError as e:
+                logging.error(f"Failed to send admin notification to {chat_id}: {e}")
+                self._blocked_until[chat_id] = time.monotonic() + NOTIFY_BLOCKED_COOLDOWN
+                return False
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Уведомления: временная ошибка: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Failed to send admin notification: {e}")
+                return False
+        logging.error(f"Уведомление не доставлено после {NOTIFY_MAX_ATTEMPTS} попыток: {text[:100]}")
+        return False
+
+
+notifier = Notifier()
 
 
 # --- ОБРАБОТЧИКИ РАССЫЛКИ ---
 
-@dp.callback_query(F.data == "admin_broadcast", F.from_user.id.in_(ADMIN_IDS))
+@on_callback(CB_BROADCAST, admin=True)
 async def start_broadcast(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
     await state.clear()
     await state.set_state(Form.bc)
 
-    await c.message.edit_text(
+    await show(
+        c.message,
         "📢 **Режим рассылки**\n\nВведите сообщение, которое будет отправлено **ВСЕМ** пользователям бота. Вы можете использовать форматирование Markdown/HTML.",
         reply_markup=admin_cancel_kb(),
         parse_mode="Markdown"
@@ -693,67 +1638,268 @@ async def start_broadcast(c: types.CallbackQuery, state: FSMContext):
 async def send_broadcast_message(m: types.Message, state: FSMContext):
     await state.clear()
 
-    user_ids = await asyncio.to_thread(get_all_user_ids)
+    # Получатели, записанные в очередь, тоже должны попасть в рассылку
+    await writes.flush()
+    preview = (m.text or m.caption or "")[:30]
+    job_id, total = await db.run(create_broadcast_job, m.chat.id, m.message_id, preview)
 
-    if not user_ids:
+    if not total:
         await m.answer("❌ В базе нет пользователей для рассылки.", reply_markup=admin_main_kb())
         return
 
-    sent_count = 0
-    blocked_count = 0
+    start_broadcast_job(job_id, m.chat.id, m.message_id)
+    await m.answer(f"⏳ Рассылка #{job_id} **{preview}...** запущена в фоне по {total} пользователям.\n"
+                   f"Прогресс: /broadcasts",
+                   reply_markup=broadcast_status_kb(), parse_mode="Markdown")
 
-    await m.answer(f"⏳ Начинаю рассылку **{m.text[:30]}...** по {len(user_ids)} пользователям...",
-                   parse_mode="Markdown")
 
-    for user_id in user_ids:
-        try:
-            # Примечание: форматирование MarkdownV2 или HTML должно быть корректным
-            # Используем m.copy_to, чтобы сохранить все медиа и форматирование
-            await m.copy_to(user_id)
-            sent_count += 1
-            await asyncio.sleep(0.05)  # Задержка для обхода лимитов
-        except TelegramForbiddenError:
-            blocked_count += 1
-        except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-            blocked_count += 1
+# Запущенные в этом процессе задания рассылки: job_id -> asyncio.Task
+BROADCAST_TASKS = {}
+
+
+def start_broadcast_job(job_id, from_chat_id, message_id):
+    BROADCAST_TASKS[job_id] = asyncio.create_task(run_broadcast_job(job_id, from_chat_id, message_id))
+
+
+async def resume_broadcast_jobs():
+    for job_id, from_chat_id, message_id in await db.run(get_running_broadcast_jobs):
+        logging.info(f"Рассылка #{job_id}: продолжаем после перезапуска")
+        start_broadcast_job(job_id, from_chat_id, message_id)
+
+
+async def run_broadcast_job(job_id, from_chat_id, message_id):
+    results = []
+    # Помечены "в отправке", но send() для них еще не вызывался
+    claimed = set()
+
+    async def save_results():
+        if results:
+            batch = results[:]
+            results.clear()
+            await db.run(save_broadcast_results, job_id, batch)
 
+    async def recipients():
+        # Получатели читаются из БД порциями и помечаются "в отправке" до отправки
+        while True:
+            await save_results()
+            user_ids = await db.run(claim_broadcast_recipients, job_id)
+            if not user_ids:
+                return
+            claimed.update(user_ids)
+            for user_id in user_ids:
+                yield user_id
+
+    async def send(user_id):
+        claimed.discard(user_id)
+        # То же, что m.copy_to: сохраняются медиа и форматирование
+        await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+
+    try:
+        await broadcast(recipients(), send, on_result=lambda user_id, outcome: results.append((user_id, outcome)))
+    finally:
+        await save_results()
+        if claimed:
+            # Остановка посреди рассылки: неотправленные продолжат после перезапуска
+            await db.run(release_broadcast_recipients, job_id, list(claimed))
+        BROADCAST_TASKS.pop(job_id, None)
+
+    if not await db.run(finish_broadcast_job, job_id):
+        return  # задание отменили, пока оно дорабатывало
+    _, _, sent, blocked, failed, unknown = await db.run(get_broadcast_progress, job_id)
     summary = (
-        f"✅ **Рассылка завершена!**\n\n"
-        f"Отправлено успешно: **{sent_count}**\n"
-        f"Заблокировано (не отправлено): **{blocked_count}**"
+        f"✅ **Рассылка #{job_id} завершена!**\n\n"
+        f"Отправлено успешно: **{sent}**\n"
+        f"Заблокировано (не отправлено): **{blocked}**\n"
+        f"Ошибки доставки: **{failed}**"
     )
-    await m.answer(summary, reply_markup=admin_main_kb(), parse_mode="Markdown")
+    if unknown:
+        summary += f"\nПрервано перезапуском (не повторялось): **{unknown}**"
+    try:
+        await bot.send_message(from_chat_id, summary, reply_markup=admin_main_kb(), parse_mode="Markdown")
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        logging.error(f"Failed to send broadcast summary: {e}")
+
+
+BC_JOB_STATUS = {'running': "⏳ идет", 'done': "✅ завершена", 'cancelled': "⛔ отменена"}
+
+
+@dp.message(Command("broadcasts"), F.from_user.id.in_(ADMIN_IDS))
+async def broadcast_status_cmd(m: types.Message):
+    text, kb = await render_broadcast_status()
+    await m.answer(text, reply_markup=kb, parse_mode="Markdown")
+
+
+@dp.message(Command("stats"), F.from_user.id.in_(ADMIN_IDS))
+async def stats_cmd(m: types.Message):
+    st = PRESENT_STATS
+    await m.answer(
+        "📈 **Показ экранов с запуска:**\n"
+        f"Правок сообщений: {st['edited']}\n"
+        f"Новых сообщений: {st['sent']}\n"
+        f"Без изменений, вызов не нужен: {st['unchanged']}\n"
+        f"Сразу новым сообщением (правка невозможна): {st['edit_avoided']}\n"
+        f"Неудачных правок: {st['edit_failed']}\n\n"
+        f"⏱ **Event loop:** блокировок дольше {int(loop_lag.threshold * 1000)} мс: {loop_lag.stats['stalls']}, "
+        f"худшая задержка: {loop_lag.stats['max_ms']} мс\n\n"
+        "🔔 **Уведомления администраторам:**\n"
+        f"В очереди: {notifier.pending()}, доставлено: {notifier.stats['sent']} "
+        f"(сообщений: {notifier.stats['messages']}), "
+        f"не доставлено: {notifier.stats['failed']}, потеряно (очередь полна): {notifier.stats['dropped']}"
+        + "".join(f"\n`{chat_id}`: доставлено {cs['sent']}, не доставлено {cs['failed']}, потеряно {cs['dropped']}"
+                  for chat_id, cs in notifier.chat_stats.items()),
+        parse_mode="Markdown")
+
+
+@dp.message(Command("reload"), F.from_user.id.in_(ADMIN_IDS))
+async def reload_content_cmd(m: types.Message):
+    # Ручная перезагрузка content.json (обычно файл подхватывается сам за несколько секунд)
+    try:
+        content = content_store.reload()
+    except (OSError, ContentError) as e:
+        await m.answer(f"❌ Контент не обновлён, бот работает на прежней версии.\n{e}")
+        return
+    questions = sum(len(bank) for _, bank in content.tests.values())
+    await m.answer(f"✅ Контент обновлён: направлений {len(content.subjects)}, вопросов в тестах {questions}.")
+
+
+@on_callback(CB_BC_STATUS, admin=True)
+async def broadcast_status_cb(c: types.CallbackQuery, state: FSMContext):
+    await c.answer()
+    text, kb = await render_broadcast_status()
+    await show(c.message, text, reply_markup=kb, parse_mode="Markdown")
+
+
+@on_callback(CB_BC_CANCEL, admin=True)
+async def cancel_broadcast(c: types.CallbackQuery, state: FSMContext, job_id):
+    cancelled = await db.run(finish_broadcast_job, job_id, 'cancelled')
+    task = BROADCAST_TASKS.get(job_id)
+    if task:
+        task.cancel()
+    await c.answer(f"Рассылка #{job_id} отменена." if cancelled else "Рассылка уже завершена.")
+    text, kb = await render_broadcast_status()
+    await show(c.message, text, reply_markup=kb, parse_mode="Markdown", send_new=False)
+
+
+async def render_broadcast_status():
+    jobs = await db.run(get_recent_broadcast_jobs)
+    text = "📊 **Рассылки:**\n\n"
+    kb = InlineKeyboardBuilder()
+    if not jobs:
+        text += "Рассылок пока не было."
+    for job_id, preview, status, created_at, progress in jobs:
+        pending, sending, sent, blocked, failed, unknown = progress
+        total = sum(progress)
+        date = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+        text += (f"#{job_id} {BC_JOB_STATUS.get(status, status)} ({date})\n"
+                 f"_{preview}..._\n"
+                 f"Обработано: {total - pending - sending} из {total} | "
+                 f"✅ {sent} | 🚫 {blocked} | ⚠️ {failed + unknown}\n---\n")
+        if status == 'running':
+            kb.row(types.InlineKeyboardButton(text=f"⛔ Отменить #{job_id}",
+                                              callback_data=pack(CB_BC_CANCEL, job_id)))
+    kb.row(types.InlineKeyboardButton(text="🔄 Обновить", callback_data=CB_BC_STATUS))
+    kb.row(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=CB_ADMIN))
+    return text, kb.as_markup()
 
 
 # --- КОНЕЦ ОБРАБОТЧИКОВ РАССЫЛКИ ---
 
 
-@dp.callback_query(F.data == "admin_users_list", F.from_user.id.in_(ADMIN_IDS))
-async def show_all_users(c: types.CallbackQuery):
+MD_SPECIAL = re.compile(r'([_*`\[])')
+
+
+def md_escape(text):
+    # Пользовательский текст в Markdown-сообщении: одиночный "_" ломает разбор всей страницы
+    return MD_SPECIAL.sub(r'\\\1', text)
+
+
+def render_user_entry(user_id, name, phone):
+    # Имя обрезаем, чтобы одна запись не могла занять всю страницу
+    name = name if name and len(name) <= 100 else f"{(name or '')[:100]}…"
+    return f"ID: `{user_id}`\nИмя: {md_escape(name)}\nТелефон: {md_escape(str(phone))}\n---\n"
+
+
+def render_question_entry(q_id, user_id, q_text, created_at, name):
+    user_name = name if name else "Аноним"
+    user_name = user_name if len(user_name) <= 100 else f"{user_name[:100]}…"
+    if len(q_text) > QUESTION_PREVIEW_LEN:
+        q_text = f"{q_text[:QUESTION_PREVIEW_LEN]}…"
+    date = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
+    return (f"ID: {q_id} | От: {md_escape(user_name)} (`{user_id}`)\n"
+            f"Дата: {date}\nТекст: {md_escape(q_text)}\n---\n")
+
+
+@on_callback(CB_USERS, admin=True)
+async def show_all_users(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
-    users = await asyncio.to_thread(get_all_users)
+    await show_users_page(c)
+
+
+@on_callback(CB_USERS_NEXT, admin=True)
+async def next_users(c: types.CallbackQuery, state: FSMContext, user_id):
+    await c.answer()
+    await show_users_page(c, user_id)
+
+
+@on_callback(CB_USERS_PREV, admin=True)
+async def prev_users(c: types.CallbackQuery, state: FSMContext, user_id):
+    await c.answer()
+    await show_users_page(c, user_id, backward=True)
+
+
+async def show_users_page(c: types.CallbackQuery, cursor=None, backward=False):
+    users, more = await db.run(get_users_page, render_user_entry, cursor, backward)
+    if not users and cursor is not None:
+        # Соседняя страница опустела (пользователей удалили) — показываем первую
+        cursor, backward = None, False
+        users, more = await db.run(get_users_page, render_user_entry)
+    has_prev = more if backward else cursor is not None
+    has_next = True if backward else more
 
     text = "👥 **Список всех пользователей:**\n\n"
+    kb = InlineKeyboardBuilder()
     if not users:
         text += "Нет зарегистрированных пользователей."
     else:
-        for user_id, name, phone in users:
-            text += f"ID: `{user_id}`\nИмя: {name}\nТелефон: {phone}\n---\n"
+        text += "".join(entry for _, entry in users)
+        nav = []
+        if has_prev:
+            nav.append(types.InlineKeyboardButton(text="⬅️ Назад по списку",
+                                                  callback_data=pack(CB_USERS_PREV, users[0][0])))
+        if has_next:
+            nav.append(types.InlineKeyboardButton(text="Далее ➡️",
+                                                  callback_data=pack(CB_USERS_NEXT, users[-1][0])))
+        if nav:
+            kb.row(*nav)
+
+    kb.row(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=CB_ADMIN))
+    await show(c.message, text, parse_mode="Markdown", reply_markup=kb.as_markup())
+
+
+# --- ОБНОВЛЕННЫЙ ОБРАБОТЧИК ПОКАЗА ВОПРОСОВ (ПОСТРАНИЧНО) ---
+@on_callback(CB_QUESTIONS, admin=True)
+async def show_all_questions(c: types.CallbackQuery, state: FSMContext):
+    await c.answer()
+    await show_questions_page(c)
 
-    kb = InlineKeyboardBuilder().row(
-        types.InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel")).as_markup()
-    try:
-        await c.message.edit_text(text, parse_mode="Markdown", reply_markup=kb)
-    except TelegramBadRequest:
-        await c.message.answer(text, parse_mode="Markdown", reply_markup=kb)
+
+@on_callback(CB_Q_OLD, admin=True)
+async def older_questions(c: types.CallbackQuery, state: FSMContext, created_at, q_id):
+    await c.answer()
+    await show_questions_page(c, (created_at, q_id))
 
 
-# --- ОБНОВЛЕННЫЙ ОБРАБОТЧИК ПОКАЗА ВОПРОСОВ ---
-@dp.callback_query(F.data == "admin_questions_list", F.from_user.id.in_(ADMIN_IDS))
-async def show_all_questions(c: types.CallbackQuery):
+@on_callback(CB_Q_NEW, admin=True)
+async def newer_questions(c: types.CallbackQuery, state: FSMContext, created_at, q_id):
     await c.answer()
-    questions = await asyncio.to_thread(get_all_questions)
+    await show_questions_page(c, (created_at, q_id), newer=True)
+
+
+async def show_questions_page(c: types.CallbackQuery, cursor=None, newer=False):
+    questions, has_older, has_newer, total = await db.run(get_questions_page, cursor, newer)
+    if not questions and cursor is not None:
+        # Граница страницы могла исчезнуть после удаления — начинаем сначала
+        questions, has_older, has_newer, total = await db.run(get_questions_page)
 
     text = "❓ **Список вопросов:**\n\n"
     kb = InlineKeyboardBuilder()
@@ -761,27 +1907,43 @@ async def show_all_questions(c: types.CallbackQuery):
     if not questions:
         text += "Вопросов пока нет."
     else:
-        # Берем ID последнего вопроса для кнопки "Ответить на последний"
-        last_question_user_id = questions[0][1]
-        kb.row(types.InlineKeyboardButton(text="➡️ Ответить на последний вопрос",
-                                          callback_data=f"admin_reply_{last_question_user_id}"))
-        kb.row(types.InlineKeyboardButton(text="—", callback_data="ignore"))
-
-        # Выводим до 5 последних вопросов для наглядности
-        for q_id, user_id, q_text, date, name in questions[:5]:
-            user_name = name if name else "Аноним"
-            text += f"ID: {q_id} | От: {user_name} (`{user_id}`)\n"
-            text += f"Дата: {date}\nТекст: _{q_text}_\n---\n"
-
-        if len(questions) > 5:
-            text += f"\n_...и еще {len(questions) - 5} вопросов._"
-
-    kb.row(types.InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel"))
-
-    try:
-        await c.message.edit_text(text, parse_mode="Markdown", reply_markup=kb.as_markup())
-    except TelegramBadRequest:
-        await c.message.answer(text, parse_mode="Markdown", reply_markup=kb.as_markup())
+        if not has_newer:
+            # Берем ID последнего вопроса для кнопки "Ответить на последний"
+            last_question_user_id = questions[0][1]
+            kb.row(types.InlineKeyboardButton(text="➡️ Ответить на последний вопрос",
+                                              callback_data=pack(CB_REPLY, last_question_user_id)))
+            kb.row(types.InlineKeyboardButton(text="—", callback_data=CB_NOOP))
+
+        # Как и список пользователей, страница ограничена длиной текста, а не
+        # только числом вопросов: не влезшие уходят на следующую страницу
+        entries, size = [], 0
+        for row in questions:
+            entry = render_question_entry(*row)
+            entry_len = len(entry.encode('utf-16-le')) // 2
+            if entries and size + entry_len > USERS_PAGE_LEN:
+                has_older = True
+                break
+            entries.append(entry)
+            size += entry_len
+        questions = questions[:len(entries)]
+        text += "".join(entries)
+
+        text += f"\n_Всего вопросов: {total}_"
+
+        first, last = questions[0], questions[-1]
+        nav = []
+        if has_newer:
+            nav.append(types.InlineKeyboardButton(text="⬅️ Новее",
+                                                  callback_data=pack(CB_Q_NEW, first[3], first[0])))
+        if has_older:
+            nav.append(types.InlineKeyboardButton(text="Старше ➡️",
+                                                  callback_data=pack(CB_Q_OLD, last[3], last[0])))
+        if nav:
+            kb.row(*nav)
+
+    kb.row(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=CB_ADMIN))
+
+    await show(c.message, text, parse_mode="Markdown", reply_markup=kb.as_markup())
 
 
 # --- КОНЕЦ ОБНОВЛЕННОГО ОБРАБОТЧИКА ---
@@ -789,42 +1951,49 @@ async def show_all_questions(c: types.CallbackQuery):
 
 # --- ОБРАБОТЧИКИ УДАЛЕНИЯ ДАННЫХ ---
 
-@dp.callback_query(F.data == "admin_delete_questions", F.from_user.id.in_(ADMIN_IDS))
-async def confirm_delete_questions(c: types.CallbackQuery):
+@on_callback(CB_DEL_Q, admin=True)
+async def confirm_delete_questions(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
-    await c.message.edit_text(
+    await show(
+        c.message,
         "⚠️ **ВНИМАНИЕ!** Вы уверены, что хотите **УДАЛИТЬ ВСЕ ВОПРОСЫ** из базы данных? Это действие необратимо!",
         reply_markup=confirm_delete_kb('questions'),
         parse_mode="Markdown"
     )
 
 
-@dp.callback_query(F.data == "admin_delete_questions_confirm", F.from_user.id.in_(ADMIN_IDS))
-async def delete_confirmed_questions(c: types.CallbackQuery):
+@on_callback(CB_DEL_Q_OK, admin=True)
+async def delete_confirmed_questions(c: types.CallbackQuery, state: FSMContext):
     await c.answer("Удаление вопросов...")
-    await asyncio.to_thread(delete_all_questions)
-    await c.message.edit_text(
+    # Сначала дописываем очередь, чтобы отложенные вставки не "воскресили" данные
+    await writes.flush()
+    await db.run(delete_all_questions)
+    await show(
+        c.message,
         "✅ **Все вопросы успешно удалены.**",
         reply_markup=admin_main_kb(),
         parse_mode="Markdown"
     )
 
 
-@dp.callback_query(F.data == "admin_delete_users", F.from_user.id.in_(ADMIN_IDS))
-async def confirm_delete_users(c: types.CallbackQuery):
+@on_callback(CB_DEL_U, admin=True)
+async def confirm_delete_users(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
-    await c.message.edit_text(
+    await show(
+        c.message,
         "⚠️ **ВНИМАНИЕ!** Вы уверены, что хотите **УДАЛИТЬ ВСЕХ ПОЛЬЗОВАТЕЛЕЙ** (включая регистрационные данные и записи на курсы) из базы данных? Это действие необратимо!",
         reply_markup=confirm_delete_kb('users'),
         parse_mode="Markdown"
     )
 
 
-@dp.callback_query(F.data == "admin_delete_users_confirm", F.from_user.id.in_(ADMIN_IDS))
-async def delete_confirmed_users(c: types.CallbackQuery):
+@on_callback(CB_DEL_U_OK, admin=True)
+async def delete_confirmed_users(c: types.CallbackQuery, state: FSMContext):
     await c.answer("Удаление пользователей...")
-    await asyncio.to_thread(delete_all_users)
-    await c.message.edit_text(
+    await writes.flush()
+    await db.run(delete_all_users)
+    await show(
+        c.message,
         "✅ **Все пользователи (и их записи на курсы) успешно удалены.**",
         reply_markup=admin_main_kb(),
         parse_mode="Markdown"
@@ -836,10 +2005,9 @@ async def delete_confirmed_users(c: types.CallbackQuery):
 
 # --- ОБРАБОТЧИКИ ОТВЕТА АДМИНИСТРАТОРА ---
 
-@dp.callback_query(F.data.startswith("admin_reply_"), F.from_user.id.in_(ADMIN_IDS))
-async def start_admin_reply(c: types.CallbackQuery, state: FSMContext):
+@on_callback(CB_REPLY, admin=True)
+async def start_admin_reply(c: types.CallbackQuery, state: FSMContext, target_user_id):
     await c.answer()
-    target_user_id = int(c.data.split("_")[2])
 
     await state.clear()
     await state.update_data(target_id=target_user_id)
@@ -870,6 +2038,7 @@ async def send_admin_reply(m: types.Message, state: FSMContext):
             f"👤 **Ответ администратора:**\n\n{m.text}",
             parse_mode="Markdown"
         )
+        writes.mark_answered(target_id)
         await m.answer(f"✅ Ответ успешно отправлен пользователю `{target_id}`.", reply_markup=admin_main_kb())
 
     except (TelegramBadRequest, TelegramForbiddenError) as e:
@@ -881,89 +2050,51 @@ async def send_admin_reply(m: types.Message, state: FSMContext):
     await state.clear()
 
 
-@dp.callback_query(F.data == "admin_cancel", F.from_user.id.in_(ADMIN_IDS))
+@on_callback(CB_ADMIN_CANCEL, admin=True)
 async def admin_cancel_action(c: types.CallbackQuery, state: FSMContext):
     await c.answer("Действие отменено.")
     # Переход в админ-панель
     await state.clear()
-    try:
-        await c.message.edit_text("❌ Действие отменено.", reply_markup=admin_main_kb())
-    except TelegramBadRequest:
-        await c.message.answer("❌ Действие отменено.", reply_markup=admin_main_kb())
+    await show(c.message, "❌ Действие отменено.", reply_markup=admin_main_kb())
 
 
-# --- (Остальные обработчики навигации) ---
-
-@dp.callback_query(F.data.startswith("cat_"))
-async def show_cat(c: types.CallbackQuery):
+@on_callback(CB_NOOP)
+async def noop(c: types.CallbackQuery, state: FSMContext):
     await c.answer()
-    _, key, lang = c.data.split("_")
-    s = STRINGS[lang]
-    kb = InlineKeyboardBuilder()
-
-    text_to_edit = SUBJECTS[key][lang]['name']
-
-    if SUBJECTS[key][lang]['items']:
-        for i, t in enumerate(SUBJECTS[key][lang]['items']):
-            kb.row(types.InlineKeyboardButton(
-                text=f"👨‍🏫 {t['n']}",
-                callback_data=f"det_{key}_{i}_{lang}"))
-    else:
-        text_to_edit = (
-            f"По направлению {SUBJECTS[key][lang]['name']} пока нет данных. Выберите другой язык или направление."
-            if lang == 'ru' else
-            f"{SUBJECTS[key][lang]['name']} yo'nalishi bo'yicha ma'lumot yo'q. Boshqa yo'nalishni tanlang."
-        )
 
-    kb.row(types.InlineKeyboardButton(text=s['back'], callback_data=f"nav_sub_{lang}"))
-
-    try:
-        await c.message.edit_text(text_to_edit, reply_markup=kb.as_markup())
-    except TelegramBadRequest:
-        await c.message.answer(text_to_edit, reply_markup=kb.as_markup())
 
+# --- (Остальные обработчики навигации) ---
 
-@dp.callback_query(F.data.startswith("det_"))
-async def show_det(c: types.CallbackQuery):
+@on_callback(CB_CAT, CB_DET)
+async def show_catalog_page(c: types.CallbackQuery, state: FSMContext, *_):
+    # Страницы каталога заранее отрендерены по полному callback_data, поля не нужны
     await c.answer()
-    _, key, idx, lang = c.data.split("_")
-    it = SUBJECTS[key][lang]['items'][int(idx)]
-
-    if lang == 'ru':
-        text = (
-            f"📖 <b>{it['n']}</b>\n"
-            f"👨‍🏫 Преподаватель: {it['t']}\n"
-            f"<b>⏰ Расписание и классы:</b>\n"
-            f"<pre>{it['s']}</pre>"
-        )
-    else:
-        text = (
-            f"📖 <b>{it['n']}</b>\n"
-            f"👨‍🏫 O'qituvchi: {it['t']}\n"
-            f"<b>⏰ Dars jadvali va sinflar:</b>\n"
-            f"<pre>{it['s']}</pre>"
-        )
+    page = CATALOG.get(c.data)
+    if page is None:
+        # Кнопка от старой версии каталога (курс или преподаватель удалены)
+        return
+    text, parse_mode, kb = page
 
-    kb = InlineKeyboardBuilder()
-    kb.row(types.InlineKeyboardButton(text=STRINGS[lang]['back'], callback_data=f"cat_{key}_{lang}"))
-
-    try:
-        await c.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
-    except TelegramBadRequest:
-        await c.message.answer(text, parse_mode="HTML", reply_markup=kb.as_markup())
+    await show(c.message, text, parse_mode=parse_mode, reply_markup=kb)
 
 
 # --- ЛОГИКА ТЕСТА (ФУНКЦИИ) ---
 
-async def ask_test_question(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    q_index = data.get('question_index', 0)
+async def ask_test_question(message: types.Message, state: FSMContext, data=None):
+    # data можно передать, если она только что получена из update_data
+    if data is None:
+        data = await state.get_data()
+    q_index = data.get('ti', 0)
     lang = data['l']
-    questions = data['test_questions']
+    questions = TEST_BANKS.get(data.get('tb'))
+
+    if questions is None:
+        await expired_test(message, state, lang)
+        return
 
     if q_index >= len(questions):
         # Конец теста
-        await finish_test(message, state)
+        await finish_test(message, state, data)
         return
 
     q_text, options, _ = questions[q_index]
@@ -971,41 +2102,28 @@ async def ask_test_question(message: types.Message, state: FSMContext):
     kb = InlineKeyboardBuilder()
     for i, option in enumerate(options):
         # В callback_data индекс вопроса и индекс ответа
-        kb.row(types.InlineKeyboardButton(text=option, callback_data=f"test_ans_{q_index}_{i}_{lang}"))
+        kb.row(types.InlineKeyboardButton(text=option, callback_data=pack(CB_TEST_ANS, q_index, i, lang)))
 
-    try:
-        # Пытаемся отредактировать предыдущее сообщение (если оно существует)
-        await message.edit_text(f"**{q_index + 1}. {q_text}**", reply_markup=kb.as_markup(), parse_mode="Markdown")
-    except (TelegramBadRequest, AttributeError):
-        # Если message.edit_text вызывает ошибку, отправляем новое.
-        await message.answer(f"**{q_index + 1}. {q_text}**", reply_markup=kb.as_markup(), parse_mode="Markdown")
+    await show(message, f"**{q_index + 1}. {q_text}**", reply_markup=kb.as_markup(), parse_mode="Markdown")
 
 
-@dp.callback_query(F.data.startswith("test_ans_"), Form.test_q)
-async def process_test_answer(c: types.CallbackQuery, state: FSMContext):
+@on_callback(CB_TEST_ANS, state=Form.test_q)
+async def process_test_answer(c: types.CallbackQuery, state: FSMContext, q_index, ans_index, lang):
     await c.answer()
 
-    # test_ans_{q_index}_{ans_index}_{lang}
-    parts = c.data.split("_")
-    if len(parts) < 5:
-        return
-
-    _, _, q_index_str, ans_index_str, lang = parts
-    q_index = int(q_index_str)
-    ans_index = int(ans_index_str)
-
     data = await state.get_data()
-    questions = data['test_questions']
-    current_score = data.get('test_score', 0)
+    questions = TEST_BANKS.get(data.get('tb'))
+    current_score = data.get('ts', 0)
+
+    if questions is None:
+        await expired_test(c.message, state, lang)
+        return
 
     # Проверка на двойное нажатие и актуальность вопроса
-    if q_index != data.get('question_index', 0):
-        try:
-            # Редактируем, чтобы убрать кнопки на старом вопросе
-            await c.message.edit_text(f"{c.message.text}\n\n_Ответ уже был засчитан._", reply_markup=None,
-                                      parse_mode="Markdown")
-        except TelegramBadRequest:
-            pass
+    if q_index != data.get('ti', 0):
+        # Редактируем, чтобы убрать кнопки на старом вопросе
+        await show(c.message, f"{c.message.text}\n\n_Ответ уже был засчитан._", parse_mode="Markdown",
+                   send_new=False)
         return
 
     correct_ans_index = questions[q_index][2]
@@ -1013,8 +2131,10 @@ async def process_test_answer(c: types.CallbackQuery, state: FSMContext):
     # Редактируем сообщение с вопросом, чтобы показать выбранный ответ
     selected_option_text = questions[q_index][1][ans_index]
 
+    answers = data.get('ta', 0)
     if ans_index == correct_ans_index:
         current_score += 1
+        answers |= 1 << q_index
         result_icon = "✅"
     else:
         correct_option_text = questions[q_index][1][correct_ans_index]
@@ -1022,28 +2142,27 @@ async def process_test_answer(c: types.CallbackQuery, state: FSMContext):
 
     # Сохраняем обновленный счет и переходим к следующему вопросу
     new_index = q_index + 1
-    await state.update_data(test_score=current_score, question_index=new_index)
-
-    # Редактирование сообщения
-    try:
-        await c.message.edit_text(
-            f"**{q_index + 1}. {questions[q_index][0]}**\n\n"
-            f"**Ваш ответ:** {selected_option_text} {result_icon}",
-            parse_mode="Markdown",
-            reply_markup=None  # Удаляем клавиатуру
-        )
-    except TelegramBadRequest:
-        pass
+    data = await state.update_data(ts=current_score, ti=new_index, ta=answers)
+
+    # Редактирование сообщения (клавиатура убирается)
+    await show(
+        c.message,
+        f"**{q_index + 1}. {questions[q_index][0]}**\n\n"
+        f"**Ваш ответ:** {selected_option_text} {result_icon}",
+        parse_mode="Markdown",
+        send_new=False
+    )
 
     # Задаем следующий вопрос
-    await ask_test_question(c.message, state)
+    await ask_test_question(c.message, state, data)
 
 
-async def finish_test(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    score = data.get('test_score', 0)
+async def finish_test(message: types.Message, state: FSMContext, data=None):
+    if data is None:
+        data = await state.get_data()
+    score = data.get('ts', 0)
     lang = data['l']
-    total_questions = len(data['test_questions'])
+    total_questions = len(TEST_BANKS[data['tb']])
 
     if lang == 'ru':
         result_text = (
@@ -1080,17 +2199,49 @@ async def finish_test(message: types.Message, state: FSMContext):
     await state.clear()
 
 
+async def expired_test(message: types.Message, state: FSMContext, lang):
+    # Банк вопросов, по которому шел тест, больше не существует
+    await message.answer(
+        "⚠️ Тест был обновлен. Пожалуйста, начните его заново." if lang == 'ru' else
+        "⚠️ Test yangilandi. Iltimos, uni qaytadan boshlang.",
+        reply_markup=main_kb(lang))
+    await state.clear()
+
+
 # --- ЗАПУСК БОТА (Polling) ---
 
 async def main():
     # Инициализация базы данных
-    await asyncio.to_thread(init_db)
+    await db.run(init_db)
+    writes.start()
+    fsm_storage.start()
+    loop_lag.start()
+    await fsm_storage.expire()
+    await resume_broadcast_jobs()
+    # Следим за content.json: правки подхватываются без перезапуска
+    content_watch = asyncio.create_task(content_store.watch())
+    # Отвеченные и лишние вопросы удаляются в фоне
+    retention = asyncio.create_task(run_questions_retention())
 
     # Удаляем вебхук для чистого запуска в режиме polling
     await bot(DeleteWebhook(drop_pending_updates=True))
 
     # Запуск
-    await dp.start_polling(bot)
+    try:
+        # Сессию закрываем сами: после polling уведомления и рассылки еще шлют через bot
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        content_watch.cancel()
+        retention.cancel()
+        await loop_lag.stop()
+        # Прерванные рассылки продолжатся при следующем запуске
+        for task in list(BROADCAST_TASKS.values()):
+            task.cancel()
+        await asyncio.gather(*BROADCAST_TASKS.values(), return_exceptions=True)
+        await notifier.close()
+        await writes.close()
+        await db.close()
+        await bot.session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+
+# Общие заготовки тестов: Telegram без сети и апдейты для dp.feed_update
+
+
+class FakeSession(BaseSession):
+    """Сессия без сети: отвечает на запросы Bot API сразу и записывает их."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return types.Message(message_id=1, date=0, chat=types.Chat(id=method.chat_id or 1, type='private'),
+                                 text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        if False:
+            yield b''
+
+    async def close(self):
+        pass
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Test"}
+
+
+def chat(user_id):
+    return {"id": user_id, "type": "private"}
+
+
+def callback_update(update_id, user_id, data):
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": user(user_id), "chat_instance": "1", "data": data,
+            "message": {"message_id": 1, "date": 0, "chat": chat(user_id), "text": "menu",
+                        "from": {"id": 1, "is_bot": True, "first_name": "Bot"}},
+        },
+    })
+
+
+def message_update(update_id, user_id, text):
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": chat(user_id), "from": user(user_id),
+                    "text": text},
+    })
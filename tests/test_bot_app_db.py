@@ -0,0 +1,94 @@
+import asyncio
+import importlib
+import os
+import sqlite3
+import sys
+
+from fakes import FakeSession, callback_update
+
+# bot_app.py и dino_club.py работают с одним dino_club.db: webhook-бот должен
+# мигрировать старую базу и писать в схему, которую ведет dino_club.py.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Dino Club'))
+
+
+def _legacy_db(path):
+    # Схема, которую bot_app создавал до общих миграций
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT)')
+    conn.execute('''CREATE TABLE questions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        question_text TEXT, date TEXT)''')
+    conn.execute('''CREATE TABLE enrollments (user_id INTEGER PRIMARY KEY, course_key TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id))''')
+    conn.execute('CREATE TABLE processed_updates (update_id INTEGER PRIMARY KEY, seen_at INTEGER)')
+    conn.execute("INSERT INTO users VALUES (1, 'Старый Ученик', '+998900000001')")
+    conn.execute("INSERT INTO questions (user_id, question_text, date) VALUES (1, 'Старый вопрос', '2024-01-01 10:00:00')")
+    conn.execute('INSERT INTO processed_updates VALUES (7, 0)')
+    conn.commit()
+    conn.close()
+
+
+def _import_bot_app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('bot_app', None)
+    return importlib.import_module('bot_app')
+
+
+def test_bot_app_writes_to_migrated_db(tmp_path, monkeypatch):
+    _legacy_db(tmp_path / 'dino_club.db')
+    bot_app = _import_bot_app(tmp_path, monkeypatch)
+    dino_db = sys.modules['dino_db']
+
+    conn = sqlite3.connect(bot_app.DB_NAME)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(dino_db.MIGRATIONS)
+    # Статус доставки, который пишет dino_club.py, не должен теряться при повторной регистрации
+    conn.execute('UPDATE users SET last_ok_at = 123 WHERE user_id = 1')
+    conn.commit()
+
+    bot_app.save_user(conn, 1, 'Новое Имя', '+998900000002')
+    bot_app.save_user(conn, 2, 'Второй Ученик', '+998900000003')
+    bot_app.save_enrollment(conn, 2, 'english')
+    bot_app.save_question(conn, 2, 'Новый вопрос')
+
+    assert conn.execute('SELECT full_name, phone, last_ok_at FROM users WHERE user_id = 1').fetchone() == \
+        ('Новое Имя', '+998900000002', 123)
+    assert bot_app.get_user_data(conn, 2) == ('Второй Ученик', '+998900000003', 'english')
+    rows, prev_start, total = bot_app.get_questions_page(conn, bot_app.NEWEST, bot_app.ADMIN_PAGE_SIZE)
+    assert [r[1] for r in rows] == ['Новый вопрос', 'Старый вопрос']
+    assert (prev_start, total) == (None, 2)
+    assert all(bot_app._question_line(r).startswith(f"❓ #{r[0]} от ") for r in rows)
+    # Число учеников берется из счетчика row_counts, а не COUNT(*)
+    rows, prev_start, total = bot_app.get_users_page(conn, 0, bot_app.ADMIN_PAGE_SIZE)
+    assert ([r[0] for r in rows], prev_start, total) == ([1, 2], None, 2)
+    bot_app.delete_users(conn, [1])
+    assert bot_app.get_users_page(conn, 0, bot_app.ADMIN_PAGE_SIZE)[2] == 1
+
+    # update_id, отмеченные до миграции, по-прежнему считаются обработанными
+    assert not bot_app.claim_update(conn, 7)
+    assert bot_app.claim_update(conn, 8)
+    conn.close()
+    asyncio.run(bot_app.db.close())
+
+
+def test_admin_callbacks_ignore_other_users(tmp_path, monkeypatch):
+    bot_app = _import_bot_app(tmp_path, monkeypatch)
+    session = FakeSession()
+    bot_app.bot.session = session
+    conn = sqlite3.connect(bot_app.DB_NAME)
+    bot_app.save_user(conn, 1, 'Ученик', '+998900000001')
+    bot_app.save_question(conn, 1, 'Вопрос')
+
+    stranger = bot_app.ADMIN_ID + 1
+    data = ["adm_b", "adm_del_u_1", "adm_del_q_1", "adm_clear_q", "adm_clear_u", "adm_l", "adm_q",
+            "adm_p_u_0_1", "adm_d_u_0_1_0"]
+
+    async def run():
+        for i, d in enumerate(data):
+            await bot_app.dp.feed_update(bot_app.bot, callback_update(i + 1, stranger, d))
+        await bot_app.db.close()
+
+    asyncio.run(run())
+    assert session.requests == []
+    assert conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM questions').fetchone()[0] == 1
+    conn.close()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+
+# Запросы и очереди polling-бота на временной базе: миграции, страницы
+# списков в админке, отложенная запись и задания рассылки.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dino_club  # noqa: E402
+from dino_db import MIGRATIONS  # noqa: E402 (путь к Dino Club добавляет dino_club)
+
+
+def _migrated(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'dino_club.db')
+    dino_club.init_db(conn)
+    return conn
+
+
+def _add_users(conn, user_ids):
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, full_name, phone) VALUES (?, ?, ?)',
+                         [(i, f"Ученик {i}", f"+99890{i:07d}") for i in user_ids])
+
+
+def test_migrations_upgrade_legacy_db(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'dino_club.db')
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, full_name TEXT, phone TEXT)')
+    conn.execute('''CREATE TABLE questions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        question_text TEXT, date TEXT)''')
+    conn.execute("INSERT INTO users VALUES (1, 'Ученик', '+998900000001')")
+    conn.execute("INSERT INTO questions (user_id, question_text, date) VALUES (1, 'Вопрос', '2024-01-01 10:00:00')")
+    conn.execute("INSERT INTO questions (user_id, question_text, date) VALUES (1, 'Удален', '2024-01-02 10:00:00')")
+    conn.execute('DELETE FROM questions WHERE id = 2')
+    conn.commit()
+
+    dino_club.init_db(conn)
+    dino_club.init_db(conn)  # повторный запуск ничего не меняет
+
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    user_id, text, created_at = conn.execute('SELECT user_id, question_text, created_at FROM questions').fetchone()
+    assert (user_id, text) == (1, 'Вопрос') and created_at > 0
+    assert dict(conn.execute('SELECT name, n FROM row_counts')) == {'questions': 1, 'users': 1}
+    assert conn.execute('SELECT delivery_status FROM users').fetchone() == (0,)
+    # id удаленного до миграции вопроса не выдается повторно
+    dino_club.save_question(conn, 1, 'Новый', int(time.time()))
+    assert conn.execute("SELECT id FROM questions WHERE question_text = 'Новый'").fetchone() == (3,)
+    conn.close()
+
+
+def test_users_pages_cover_every_user_once(tmp_path):
+    conn = _migrated(tmp_path)
+    _add_users(conn, range(1, 31))
+    render = dino_club.render_user_entry
+    max_len = 200
+
+    pages, cursor, more = [], None, True
+    while more:
+        page, more = dino_club.get_users_page(conn, render, cursor, max_len=max_len)
+        assert sum(len(entry) for _, entry in page) <= max_len
+        pages.append([user_id for user_id, _ in page])
+        cursor = page[-1][0]
+    assert [i for page in pages for i in page] == list(range(1, 31))
+    assert len(pages) > 2
+
+    # Назад от первой записи страницы - ровно предыдущая страница
+    page, more = dino_club.get_users_page(conn, render, pages[2][0], backward=True, max_len=max_len)
+    assert [user_id for user_id, _ in page] == pages[1]
+    assert more
+    conn.close()
+
+
+def test_questions_pages_keyset(tmp_path):
+    conn = _migrated(tmp_path)
+    with conn:
+        # Одинаковое время у соседних вопросов: порядок добирается по id
+        for i in range(12):
+            dino_club.save_question(conn, i, f"Вопрос {i}", 1000 + i // 3)
+    expected = [row[0] for row in conn.execute('SELECT id FROM questions ORDER BY created_at DESC, id DESC')]
+
+    first, has_older, has_newer, total = dino_club.get_questions_page(conn, limit=5)
+    assert (has_older, has_newer, total) == (True, False, 12)
+    seen, page = [], first
+    while True:
+        seen += [row[0] for row in page]
+        if not has_older:
+            break
+        last = page[-1]
+        page, has_older, has_newer, _ = dino_club.get_questions_page(conn, (last[3], last[0]), limit=5)
+        assert has_newer
+    assert seen == expected
+
+    second, _, _, _ = dino_club.get_questions_page(conn, (first[-1][3], first[-1][0]), limit=5)
+    back, has_older, has_newer, _ = dino_club.get_questions_page(conn, (second[0][3], second[0][0]),
+                                                                newer=True, limit=5)
+    assert back == first and has_older and not has_newer
+    conn.close()
+
+
+def test_write_behind_read_your_writes(tmp_path):
+    async def run():
+        db = dino_club.Database(str(tmp_path / 'dino_club.db'))
+        await db.run(dino_club.init_db)
+        writes = dino_club.WriteBehind(db, max_attempts=2)  # без start(): сбрасываем вручную
+
+        writes.save_user(1, 'Ученик', '+998900000001')
+        writes.save_enrollment(1, 'english')
+        assert await db.run(dino_club.get_user_data, 1) is None
+        assert await writes.get_user_data(1) == ('Ученик', '+998900000001', 'english')
+
+        await writes.flush()
+        assert await db.run(dino_club.get_user_data, 1) == ('Ученик', '+998900000001', 'english')
+        assert not writes._users and not writes._enrollments
+
+        # Сбойная операция не держит остальные: они коммитятся, она отбрасывается
+        def broken(conn):
+            conn.execute('INSERT INTO no_such_table VALUES (1)')
+
+        writes._put(broken, ())
+        writes.save_enrollment(1, 'math')
+        await writes.flush()
+        assert await db.run(dino_club.get_user_data, 1) == ('Ученик', '+998900000001', 'math')
+        assert writes._ops and not writes.dropped
+        await writes.flush()
+        assert not writes._ops and writes.dropped == 1
+        await db.close()
+
+    asyncio.run(run())
+
+
+def test_broadcast_claim_and_resume(tmp_path):
+    conn = _migrated(tmp_path)
+    _add_users(conn, range(1, 6))
+    with conn:
+        conn.execute('UPDATE users SET delivery_status = ?, status_at = ? WHERE user_id = 5',
+                     (dino_club.USER_BLOCKED, int(time.time())))
+
+    job_id, total = dino_club.create_broadcast_job(conn, 100, 7, 'Текст')
+    assert total == 4  # недавно заблокировавший бота не получает рассылку
+    assert dino_club.claim_broadcast_recipients(conn, job_id, limit=2) == [1, 2]
+    assert dino_club.claim_broadcast_recipients(conn, job_id, limit=2) == [3, 4]
+    dino_club.save_broadcast_results(conn, job_id, [(1, 'sent'), (2, 'blocked')])
+
+    # Перезапуск посреди отправки: 3 и 4 могли получить сообщение, повторно не шлем
+    assert dino_club.get_running_broadcast_jobs(conn) == [(job_id, 100, 7)]
+    pending, sending, sent, blocked, failed, unknown = dino_club.get_broadcast_progress(conn, job_id)
+    assert (pending, sending, sent, blocked, failed, unknown) == (0, 0, 1, 1, 0, 2)
+    assert dino_club.claim_broadcast_recipients(conn, job_id) == []
+    assert conn.execute('SELECT delivery_status FROM users WHERE user_id = 2').fetchone() == (dino_club.USER_BLOCKED,)
+
+    assert dino_club.finish_broadcast_job(conn, job_id) == 1
+    assert dino_club.finish_broadcast_job(conn, job_id, 'cancelled') == 0
+    assert dino_club.get_running_broadcast_jobs(conn) == []
+    conn.close()
@@ -0,0 +1,88 @@
+import asyncio
+import importlib
+import os
+import sqlite3
+import sys
+import threading
+
+from aiogram.methods import SendMessage
+
+from fakes import FakeSession, callback_update, message_update
+
+# Обработчики webhook-бота не должны держать event loop даже на большой базе:
+# все запросы SQLite идут через db.run. Надежная проверка - ни один запрос не
+# выполнился в потоке event loop; задержку по часам проверяем с большим запасом,
+# чтобы тест не падал на загруженной машине.
+
+ROWS = 200_000
+LAG_LIMIT_MS = 1000
+ADMIN_CALLBACKS = ("adm_l", "adm_q", "adm_clear_q", "adm_clear_u")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Dino Club'))
+
+
+def _fill_db(path):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, full_name, phone) VALUES (?, ?, ?)',
+                         ((i, f"Ученик {i}", '+998900000000') for i in range(1, ROWS + 1)))
+        conn.executemany('INSERT INTO questions (user_id, question_text, created_at) VALUES (?, ?, ?)',
+                         ((i, "Вопрос " * 20, 1704103200) for i in range(1, ROWS + 1)))
+    conn.close()
+
+
+def test_handlers_do_not_block_event_loop(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('bot_app', None)
+    bot_app = importlib.import_module('bot_app')
+    _fill_db(bot_app.DB_NAME)
+    session = FakeSession()
+    bot_app.bot.session = session
+
+    # Запоминаем SQL, выполненный в потоке event loop (asyncio.run ниже идет в этом потоке)
+    loop_thread = threading.get_ident()
+    loop_sql = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(lambda sql: loop_sql.append(sql) if threading.get_ident() == loop_thread else None)
+        return conn
+
+    student = ROWS + 1
+    updates = [
+        # Регистрация: запись пользователя и курса, уведомления админу
+        callback_update(1, student, "nav_reg_ru"),
+        callback_update(2, student, "reg_type_new_ru"),
+        message_update(3, student, "Новый Ученик"),
+        message_update(4, student, "+998901234567"),
+        callback_update(5, student, f"reg_course_{next(iter(bot_app.SUBJECTS))}_ru"),
+        callback_update(6, student, "nav_cab_ru"),
+    ]
+    updates += [callback_update(10 + i, bot_app.ADMIN_ID, data) for i, data in enumerate(ADMIN_CALLBACKS)]
+
+    async def run():
+        monitor = bot_app.loop_lag
+        monitor.interval = 0.01
+        monitor.start()
+        await asyncio.sleep(0.05)
+        for update in updates:
+            await bot_app.dp.feed_update(bot_app.bot, update)
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+        await bot_app.db.close()
+        return monitor.stats
+
+    with monkeypatch.context() as patch:
+        patch.setattr(sqlite3, 'connect', traced_connect)
+        stats = asyncio.run(run())
+
+    assert not loop_sql, f"SQL выполнен в потоке event loop: {loop_sql[:3]}"
+    assert stats['checks'] > 0
+    assert stats['max_ms'] < LAG_LIMIT_MS, f"event loop заблокирован на {stats['max_ms']} мс"
+    # Обработчики действительно отработали: админские запросы дошли до базы
+    conn = sqlite3.connect(bot_app.DB_NAME)
+    assert conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM questions').fetchone()[0] == 0
+    conn.close()
+    assert any(isinstance(r, SendMessage) and r.text.startswith("👥") for r in session.requests)